@@ -0,0 +1,170 @@
+import numpy as np
+import copy
+import time
+
+from buckets import BucketTable
+from pair_finder import PairFinder
+
+
+"""Chooses sig_len and bands from the data, instead of hours of experiments.
+
+The exact Jaccard similarities of a sample of documents to all others
+give the distribution of the similarity of random pairs. With the
+S-curve 1 - (1 - s^r)^b this gives the expected number of candidates
+and of true pairs for every configuration. Together with costs measured
+on the live data, the configuration with the most expected true pairs
+per minute within the time budget is chosen.
+
+One-permutation hashing can't be tuned: the densified bins of sparse
+documents are copies of each other, so bands don't collide
+independently and the S-curve doesn't hold.
+"""
+
+
+# bins of the similarity distribution
+_EDGES = np.linspace(0, 1, 2001)
+
+
+def sample_density(pf, n_samples=200, block_size=2**22):
+    """Returns the share of random pairs with a similarity in every bin of _EDGES.
+
+    The similarities of n_samples random documents to all others are
+    computed exactly, block_size at a time. Every pair is as likely to
+    be counted as with random pairs, but the sample also holds the few
+    most similar documents of every sampled one.
+    """
+    docs = np.random.choice(pf.n_docs, size=min(n_samples, pf.n_docs), replace=False)
+    sample = pf.DU[docs].T.astype(np.int32)
+    sizes = pf.doc_sizes[docs].reshape(1, -1)
+    block = max(block_size // len(docs), 1)
+
+    counts = np.zeros(len(_EDGES) - 1, dtype=np.int64)
+    for start in range(0, pf.n_docs, block):
+        stop = min(start + block, pf.n_docs)
+        inter = pf.DU[start:stop].astype(np.int32).dot(sample).toarray()
+        union = pf.doc_sizes[start:stop].reshape(-1, 1) + sizes - inter
+        other = np.arange(start, stop).reshape(-1, 1) != docs.reshape(1, -1)
+        counts += np.histogram(inter[other] / np.maximum(union[other], 1), bins=_EDGES)[0]
+    return counts / max(np.sum(counts), 1)
+
+
+def s_curve(s, rows, bands):
+    """Probability that a pair with similarity s becomes a candidate."""
+    return 1 - (1 - s ** rows) ** bands
+
+
+def measure_costs(pf, n_pairs=100000, n_hashes=8):
+    """Measures per-hash, per-band and per-candidate costs in seconds.
+
+    Signatures and buckets are computed on a copy of pf with n_hashes
+    hash functions, so pf itself only needs its matrices prepared. The
+    copy computes them like PairFinder, in memory, so no cache entries
+    or spill files are written.
+
+    Returns:
+        dict: per_hash, per_band and per_pair costs.
+    """
+    probe = copy.copy(pf)
+    probe.set_params(n_hashes, n_hashes // 2)
+
+    t = time.time()
+    PairFinder._compute_signatures(probe)
+    PairFinder._pack_signatures(probe)
+    signature_t = time.time() - t
+
+    t = time.time()
+    BucketTable.from_signatures(probe.S, probe.n_bands)
+    band_t = (time.time() - t) / probe.n_bands
+
+    c1 = np.random.randint(0, pf.n_docs, n_pairs)
+    c2 = np.random.randint(0, pf.n_docs, n_pairs)
+    t = time.time()
+    probe.sig_sim(c1, c2)
+    pf.verify_batch(c1, c2)
+    pair_t = (time.time() - t) / n_pairs
+
+    return {'per_hash': signature_t / n_hashes, 'per_band': band_t, 'per_pair': pair_t}
+
+
+def choose_params(density, n_docs, costs, budget, overhead=0.0, min_recall=.9,
+                  threshold=.5, max_sig_len=350, max_rows=40):
+    """Returns the (sig_len, bands) with the most expected true pairs per minute.
+
+    Only configurations expected to find at least min_recall of all true
+    pairs are considered, so that speed isn't bought with most of the
+    pairs. If there is none, the one finding the most pairs is chosen.
+
+    Args:
+        density (numpy.ndarray): Share of random pairs in every
+            similarity bin, see sample_density.
+        n_docs (int): Number of documents.
+        costs (dict): Costs as returned by measure_costs.
+        budget (float): Seconds available for preparing and verifying.
+        overhead (float): Seconds already spent, counted in the run time.
+        min_recall (float): Minimum expected share of true pairs found.
+        threshold (float): Similarity of true pairs.
+        max_sig_len (int): Largest signature length to consider.
+        max_rows (int): Largest number of rows per band to consider.
+
+    Returns:
+        tuple: (sig_len, bands, expected true pairs found, expected candidates)
+    """
+    s = (_EDGES[:-1] + _EDGES[1:]) / 2
+    n_pairs = n_docs * (n_docs - 1) / 2
+    if not np.any(density[s > threshold]):
+        # no true pair was sampled, assume a single one just above the threshold
+        density = density.copy()
+        density[np.argmax(s > threshold)] = 1 / n_pairs
+
+    rows, bands = np.meshgrid(np.arange(1, max_rows + 1), np.arange(1, max_sig_len + 1))
+    rows, bands = rows.ravel(), bands.ravel()
+    ok = rows * bands <= max_sig_len
+    rows, bands = rows[ok], bands[ok]
+
+    p = s_curve(s.reshape(1, -1), rows.reshape(-1, 1), bands.reshape(-1, 1))
+    candidates = n_pairs * p.dot(density)
+    true_pairs = n_pairs * p[:, s > threshold].dot(density[s > threshold])
+
+    setup = rows * bands * costs['per_hash'] + bands * costs['per_band']
+    verify = candidates * costs['per_pair']
+
+    # only the part of the candidates verified within the budget counts
+    verified = np.clip((budget - setup) / np.maximum(verify, 1e-12), 0, 1)
+    found = true_pairs * verified
+    per_minute = found / (overhead + np.minimum(setup + verify, budget)) * 60
+
+    recall = found / (n_pairs * np.sum(density[s > threshold]))
+    if np.any(recall >= min_recall):
+        best = np.argmax(np.where(recall >= min_recall, per_minute, -1))
+    else:
+        best = np.argmax(found)
+    return int(rows[best] * bands[best]), int(bands[best]), found[best], candidates[best]
+
+
+def autotune(pf, budget, overhead=0.0, n_samples=200):
+    """Chooses and sets sig_len and bands of pf for the given time budget.
+
+    pf needs its matrices prepared (see PairFinder.prepare_matrices) and
+    min-hash or permutation signatures. overhead is the time already
+    spent before, which counts towards the run time but not the budget.
+    n_samples documents are sampled for the similarity distribution.
+    """
+    if pf.signature_method == 'oph':
+        raise ValueError("One-permutation signatures can't be autotuned")
+
+    print("Autotuning...")
+    t = time.time()
+
+    density = sample_density(pf, n_samples)
+
+    costs = measure_costs(pf)
+    elapsed = time.time() - t
+    sig_len, bands, found, candidates = choose_params(
+        density, pf.n_docs, costs, budget - elapsed, overhead + elapsed)
+    pf.set_params(sig_len, bands)
+
+    print("Measured costs: {}".format(costs))
+    print("Chose sig len {} and {} bands: about {} candidates, {} true pairs".format(
+        sig_len, bands, int(candidates), found))
+    print("Done in {}s".format(time.time() - t))
+    return sig_len, bands
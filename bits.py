@@ -0,0 +1,124 @@
+import numpy as np
+
+
+"""Helpers for bit-packed matrices."""
+
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(x):
+    """Returns the number of set bits of every element of an uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+
+    # SWAR popcount for numpy versions without bitwise_count
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def pack_rows(csr, block=4096):
+    """Packs the rows of a binary sparse matrix into uint64 words.
+
+    Args:
+        csr (scipy.sparse.csr_matrix): Binary matrix.
+        block (int): Number of rows converted to dense at once.
+
+    Returns:
+        numpy.ndarray: Array of shape (rows, ceil(columns / 64)), where
+            every row holds the bits of the corresponding matrix row.
+    """
+    n_rows, n_cols = csr.shape
+    n_words = -(-n_cols // 64)
+    packed = np.zeros((n_rows, n_words), dtype=np.uint64)
+    as_bytes = packed.view(np.uint8)
+
+    for start in range(0, n_rows, block):
+        stop = min(start + block, n_rows)
+        row_bytes = np.packbits(csr[start:stop].toarray() != 0, axis=1)
+        as_bytes[start:stop, :row_bytes.shape[1]] = row_bytes
+
+    return packed
+
+
+def intersection_sizes(packed, c1, c2, block=4096):
+    """Returns the number of common bits of rows c1[k] and c2[k] for all k.
+
+    Args:
+        packed (numpy.ndarray): Matrix created by pack_rows.
+        c1 (numpy.ndarray): Indices of the first rows.
+        c2 (numpy.ndarray): Indices of the second rows.
+        block (int): Number of pairs compared at once.
+    """
+    inter = np.empty(len(c1), dtype=np.int64)
+    for start in range(0, len(c1), block):
+        stop = min(start + block, len(c1))
+        common = packed[c1[start:stop]] & packed[c2[start:stop]]
+        inter[start:stop] = np.sum(popcount(common), axis=1, dtype=np.int64)
+    return inter
+
+
+def pack_low_bits(S, b):
+    """Packs the lowest b bits of every signature value into uint64 words.
+
+    Args:
+        S (numpy.ndarray): Signature matrix of shape (sig_len, n_docs).
+        b (int): Bits kept per value. Must divide 64, so that no value
+            spans two words.
+
+    Returns:
+        numpy.ndarray: Array of shape (n_docs, ceil(sig_len * b / 64)),
+            one row per document. Unused fields at the end are zero.
+    """
+    if 64 % b != 0:
+        raise ValueError("b ({}) must divide 64".format(b))
+
+    per_word = 64 // b
+    sig_len, n_docs = S.shape
+    n_words = -(-sig_len // per_word)
+
+    low = np.zeros((n_words * per_word, n_docs), dtype=np.uint64)
+    low[:sig_len, :] = S.astype(np.uint64) & np.uint64((1 << b) - 1)
+    low.shape = (n_words, per_word, n_docs)
+
+    packed = np.zeros((n_words, n_docs), dtype=np.uint64)
+    for k in range(per_word):
+        packed |= low[:, k, :] << np.uint64(k * b)
+    return np.ascontiguousarray(packed.T)
+
+
+def bbit_similarity(packed, i, j, b, sig_len):
+    """Estimates the similarity of documents from b-bit signatures.
+
+    Counts the fields in which rows i and j of packed agree, and
+    corrects for the chance 2^-b of two different values agreeing in
+    their lowest b bits: R = (P - 2^-b) / (1 - 2^-b).
+
+    Args:
+        packed (numpy.ndarray): Signatures created by pack_low_bits.
+        i: Document ID or array of document IDs.
+        j: Document ID or array of document IDs.
+        b (int): Bits per value.
+        sig_len (int): Number of values per signature.
+
+    Returns:
+        Estimated similarity (an array if i and j are arrays).
+    """
+    x = packed[i] ^ packed[j]
+
+    # fold every field onto its lowest bit
+    shift = 1
+    while shift < b:
+        x = x | (x >> np.uint64(shift))
+        shift *= 2
+    low_bits = np.uint64(sum(1 << k for k in range(0, 64, b)))
+    differing = np.sum(popcount(x & low_bits), axis=-1, dtype=np.int64)
+
+    p = (sig_len - differing) / sig_len
+    chance = 2.0 ** -b
+    return np.clip((p - chance) / (1 - chance), 0, 1)
@@ -0,0 +1,304 @@
+import numpy as np
+
+
+"""Array-backed LSH bucket table.
+
+Instead of a dictionary of sets, buckets are stored like a CSR matrix:
+the members of all buckets are concatenated (sorted by band and bucket
+key), and an offset array marks where each bucket starts. Buckets with
+only one member never produce candidates and are not stored, but they
+are counted in n_used.
+"""
+
+
+def pack_pairs(c1, c2):
+    """Encodes pairs of document IDs as uint64 keys (min << 32 | max)."""
+    lo = np.minimum(c1, c2).astype(np.uint64)
+    hi = np.maximum(c1, c2).astype(np.uint64)
+    return (lo << np.uint64(32)) | hi
+
+
+def unpack_pairs(keys):
+    """Decodes keys created by pack_pairs into two int64 arrays."""
+    c1 = (keys >> np.uint64(32)).astype(np.int64)
+    c2 = (keys & np.uint64(0xffffffff)).astype(np.int64)
+    return c1, c2
+
+
+def mix(h):
+    """splitmix64 finalizer, applied element-wise to an uint64 array."""
+    h = h ^ (h >> np.uint64(30))
+    h = h * np.uint64(0xbf58476d1ce4e5b9)
+    h = h ^ (h >> np.uint64(27))
+    h = h * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def band_keys(band):
+    """Returns a 64-bit key for every column of a signature band.
+
+    Args:
+        band (numpy.ndarray): Signature rows of one band, shape
+            (rows, n_docs).
+
+    Returns:
+        numpy.ndarray: uint64 array of length n_docs. Columns with equal
+            values get equal keys, and different columns collide with
+            probability of about 2^-64.
+    """
+    h = np.full(band.shape[1], 0x9e3779b97f4a7c15, dtype=np.uint64)
+    for row in band:
+        h = mix(h ^ row.astype(np.uint64))
+    return h
+
+
+def signature_keys(S, n_bands):
+    """Returns the bucket key of every column of S in each of n_bands bands."""
+    band_len = S.shape[0] // n_bands
+    keys = np.empty((n_bands, S.shape[1]), dtype=np.uint64)
+    for b in range(n_bands):
+        keys[b, :] = band_keys(S[b*band_len:(b+1)*band_len, :])
+    return keys
+
+
+class BucketTable:
+    """LSH buckets of all bands in a CSR-like layout.
+
+    Attributes:
+        keys (numpy.ndarray): Bucket key of every document in every band,
+            shape (n_bands, n_docs).
+        offsets (numpy.ndarray): Start of every bucket in members, plus
+            the end of the last bucket.
+        members (numpy.ndarray): Document IDs of all buckets, sorted by
+            (band, key).
+        bands (numpy.ndarray): Band of every bucket.
+        n_used (int): Number of non-empty buckets, including those with
+            a single member.
+        avoided (int): Number of candidate pairs avoided by split().
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.avoided = 0
+        self._build()
+
+    def _build(self):
+        keys = self.keys
+        n_bands, n_docs = keys.shape
+
+        # sort documents by key within every band
+        order = np.argsort(keys, axis=1, kind='mergesort')
+        sorted_keys = keys[np.arange(n_bands).reshape(-1, 1), order]
+
+        starts = np.ones(keys.shape, dtype=bool)
+        starts[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+        starts = np.nonzero(starts.ravel())[0]
+        sizes = np.diff(np.append(starts, keys.size))
+        self.n_used = len(starts)
+
+        keep = sizes > 1
+        self.members = order.ravel()[np.repeat(keep, sizes)].astype(np.int32)
+        self.offsets = np.zeros(np.sum(keep) + 1, dtype=np.int64)
+        np.cumsum(sizes[keep], out=self.offsets[1:])
+        self.bands = (starts[keep] // n_docs).astype(np.int32)
+        if hasattr(self, '_bucket_keys'):
+            del self._bucket_keys # lookup of neighbours() is outdated
+
+    @classmethod
+    def from_signatures(cls, S, n_bands):
+        """Builds the table from a signature matrix with n_bands bands."""
+        return cls(signature_keys(S, n_bands))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Creates a table from the arrays returned by to_arrays()."""
+        table = cls.__new__(cls)
+        for name in ('keys', 'offsets', 'members', 'bands'):
+            setattr(table, name, arrays[name])
+        table.n_used = int(arrays['n_used'])
+        table.avoided = int(arrays['avoided'])
+        return table
+
+    def to_arrays(self):
+        """Returns a dict of the arrays that make up the table."""
+        return {'keys': self.keys, 'offsets': self.offsets, 'members': self.members,
+                'bands': self.bands, 'n_used': np.array(self.n_used),
+                'avoided': np.array(self.avoided)}
+
+    def split(self, max_size, extra_signatures, max_depth=3):
+        """Splits buckets with more than max_size members.
+
+        Members of an oversized bucket are re-hashed on extra signature
+        rows, and their key is combined with the key of these rows, so
+        the bucket falls apart into smaller ones. This is repeated with
+        new rows for buckets that are still too large, up to max_depth
+        times.
+
+        Args:
+            max_size (int): Maximum number of members per bucket.
+            extra_signatures (callable): Called with an array of document
+                IDs, returns new signature rows for them, shape (rows,
+                len(docs)). Must use new hash functions on every call.
+            max_depth (int): Maximum number of times a bucket is split.
+        """
+        before = self.count_candidates()
+
+        for depth in range(max_depth):
+            big = np.nonzero(self.sizes() > max_size)[0]
+            if len(big) == 0:
+                break
+
+            for band in np.unique(self.bands[big]):
+                in_band = big[self.bands[big] == band]
+                docs = np.concatenate([
+                    self.members[self.offsets[i]:self.offsets[i + 1]] for i in in_band])
+                sub_keys = band_keys(extra_signatures(docs))
+                self.keys[band, docs] = mix(self.keys[band, docs] ^ sub_keys)
+
+            self._build()
+
+        self.avoided += before - self.count_candidates()
+
+    def update(self, docs, keys):
+        """Changes the keys of some documents and returns the pairs this made candidates.
+
+        The table grows if docs contains new documents. Pairs are only
+        returned if they share a bucket now, but didn't share one in
+        any band before.
+
+        Args:
+            docs (numpy.ndarray): Sorted, distinct document IDs.
+            keys (numpy.ndarray): Their new keys, shape (n_bands, len(docs)).
+
+        Returns:
+            tuple: (c1, c2) arrays with c1 < c2.
+        """
+        if len(docs) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        n_bands, old_n_docs = self.keys.shape
+        n_docs = max(old_n_docs, int(docs[-1]) + 1)
+
+        # always copy, the keys may be memory-mapped read-only
+        grown = np.zeros((n_bands, n_docs), dtype=np.uint64)
+        grown[:, :old_n_docs] = self.keys
+        old = grown[:, docs].copy()
+        grown[:, docs] = keys
+        self.keys = grown
+        self._build()
+
+        c1, c2 = self.pairs_with(docs)
+
+        # drop pairs that already shared a bucket with their old keys
+        lookup = np.full(n_docs, -1, dtype=np.int64)
+        lookup[docs] = np.arange(len(docs))
+        i1, i2 = lookup[c1], lookup[c2]
+        before = np.zeros(len(c1), dtype=bool)
+        for b in range(n_bands):
+            k1 = np.where(i1 >= 0, old[b, i1], self.keys[b, c1])
+            k2 = np.where(i2 >= 0, old[b, i2], self.keys[b, c2])
+            before |= k1 == k2
+        # new documents weren't in any bucket
+        before &= np.maximum(c1, c2) < old_n_docs
+
+        return c1[~before], c2[~before]
+
+    def pairs_with(self, docs, max_size = None):
+        """Returns all distinct pairs of one of docs with another member of its buckets.
+
+        Args:
+            docs (numpy.ndarray): Document IDs.
+            max_size (int, optional): Ignore buckets with more members.
+
+        Returns:
+            tuple: (c1, c2) arrays with c1 < c2.
+        """
+        sizes = self.sizes()
+        bucket = np.repeat(np.arange(len(sizes)), sizes)
+        wanted = np.zeros(self.keys.shape[1], dtype=bool)
+        wanted[docs] = True
+        pos = np.nonzero(wanted[self.members])[0]
+        if max_size:
+            pos = pos[sizes[bucket[pos]] <= max_size]
+
+        counts = sizes[bucket[pos]]
+        total = int(np.sum(counts))
+        k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        c1 = np.repeat(self.members[pos], counts)
+        c2 = self.members[np.repeat(self.offsets[bucket[pos]], counts) + k]
+        keep = c1 != c2
+        return unpack_pairs(np.unique(pack_pairs(c1[keep], c2[keep])))
+
+    def neighbours(self, doc):
+        """Returns all other documents that share a bucket with doc in any band."""
+        if not hasattr(self, '_bucket_keys'):
+            # stored buckets are sorted by (band, key)
+            self._bucket_keys = self.keys[self.bands, self.members[self.offsets[:-1]]]
+            self._band_starts = np.searchsorted(self.bands, np.arange(self.keys.shape[0] + 1))
+
+        found = []
+        for b in range(self.keys.shape[0]):
+            lo, hi = self._band_starts[b], self._band_starts[b + 1]
+            i = lo + np.searchsorted(self._bucket_keys[lo:hi], self.keys[b, doc])
+            if i < hi and self._bucket_keys[i] == self.keys[b, doc]:
+                found.append(self.members[self.offsets[i]:self.offsets[i + 1]])
+
+        if len(found) == 0:
+            return np.array([], dtype=self.members.dtype)
+        docs = np.unique(np.concatenate(found))
+        return docs[docs != doc]
+
+    def __len__(self):
+        return self.n_used
+
+    def __iter__(self):
+        """Yields the members of every bucket with more than one member."""
+        for i in range(len(self.offsets) - 1):
+            yield self.members[self.offsets[i]:self.offsets[i + 1]]
+
+    def pair_batches(self, batch_size=2**16):
+        """Yields all distinct pairs of documents that share a bucket.
+
+        Pairs are enumerated by index over all buckets, so every batch
+        has at most batch_size pairs no matter how large single buckets
+        are. A pair is only emitted for the lowest band in which it
+        collides, which removes duplicates across batches without
+        remembering pairs. Within a batch, pairs are packed into uint64
+        keys and sorted.
+
+        Yields:
+            tuple: (c1, c2) arrays with c1 < c2.
+        """
+        sizes = self.sizes()
+        ends = np.repeat(self.offsets[1:], sizes)
+        # number of pairs starting at every member position
+        n_pairs = ends - np.arange(len(self.members)) - 1
+        n_pairs_cum = np.cumsum(n_pairs)
+        total = int(n_pairs_cum[-1]) if len(n_pairs_cum) > 0 else 0
+        member_bands = np.repeat(self.bands, sizes)
+        del ends
+
+        for start in range(0, total, batch_size):
+            k = np.arange(start, min(start + batch_size, total), dtype=np.int64)
+            pos = np.searchsorted(n_pairs_cum, k, side='right')
+            partner = pos + 1 + k - (n_pairs_cum[pos] - n_pairs[pos])
+            c1 = self.members[pos]
+            c2 = self.members[partner]
+            band = member_bands[pos]
+
+            # drop pairs that already collided in an earlier band
+            dup = np.zeros(len(k), dtype=bool)
+            for b in range(int(np.max(band))):
+                dup |= (band > b) & (self.keys[b, c1] == self.keys[b, c2])
+
+            keys = np.unique(pack_pairs(c1[~dup], c2[~dup]))
+            yield unpack_pairs(keys)
+
+    def sizes(self):
+        """Returns the number of members of every stored bucket."""
+        return np.diff(self.offsets)
+
+    def count_candidates(self):
+        """Returns the number of pairs in all buckets, including duplicates."""
+        n = self.sizes()
+        return int(np.sum(n * (n - 1) // 2))
@@ -0,0 +1,164 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from util import ensure_directory
+
+
+"""Content-addressed cache of numpy arrays.
+
+Every entry is a directory named after a hash of everything its arrays
+depend on (see key()), holding one .npy file per array, so entries are
+memory-mapped when loaded and never go stale: changing the input data,
+the seed or a parameter changes the key. An index file remembers the
+size and last use of every entry, and least recently used entries are
+evicted when the cache grows beyond its size cap.
+
+Results that depend on random draws are keyed on the state of numpy's
+random number generator before computing them, which covers the seed
+as well as everything drawn before. The state after computing them is
+stored with the arrays and restored on a hit, so a cached run draws
+the same numbers afterwards as an uncached one.
+"""
+
+
+def key(*parts):
+    """Returns the hex digest of a hash of parts (anything with a stable repr)."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def random_state_key():
+    """Returns a hash of the current state of numpy's random number generator."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    h = hashlib.sha1(keys.tobytes())
+    h.update(repr((name, pos, has_gauss, cached_gaussian)).encode())
+    return h.hexdigest()
+
+
+def random_state_arrays():
+    """Returns the state of numpy's random number generator as arrays."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'rng_keys': keys, 'rng_rest': np.array([pos, has_gauss, cached_gaussian])}
+
+
+def restore_random_state(arrays):
+    """Restores a state returned by random_state_arrays()."""
+    pos, has_gauss, cached_gaussian = arrays['rng_rest']
+    np.random.set_state(('MT19937', np.array(arrays['rng_keys']),
+                         int(pos), int(has_gauss), float(cached_gaussian)))
+
+
+class ArtifactCache:
+    """Directory of cached arrays with least-recently-used eviction.
+
+    Args:
+        directory (string): Where entries and the index are stored.
+        max_bytes (int, optional): Size cap for all entries together.
+            Default: no cap.
+    """
+
+    def __init__(self, directory = "cache", max_bytes = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(directory, "index.json")
+        ensure_directory(directory)
+
+    def get(self, k):
+        """Returns the arrays stored under key k, memory-mapped, or None."""
+        path = os.path.join(self.directory, k)
+        index = self._read_index()
+        if k not in index['entries'] or not os.path.isdir(path):
+            return None
+
+        arrays = {}
+        for name in index['entries'][k]['arrays']:
+            arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+        index['entries'][k]['used'] = time.time()
+        self._write_index(index)
+        return arrays
+
+    def put(self, k, arrays):
+        """Stores a dict of arrays under key k and evicts old entries if needed."""
+        path = os.path.join(self.directory, k)
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        ensure_directory(tmp)
+        size = 0
+        for name, array in arrays.items():
+            f = os.path.join(tmp, name + ".npy")
+            np.save(f, array)
+            size += os.path.getsize(f)
+
+        # an entry only appears once it is complete
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+
+        index = self._read_index()
+        index['entries'][k] = {'arrays': list(arrays), 'size': size, 'used': time.time()}
+        self._evict(index, keep=k)
+        self._write_index(index)
+
+    def fingerprint(self, data, chunk_size = 2**24):
+        """Returns a hash of the contents of data.
+
+        Hashes of memory-mapped files are remembered in the index by
+        path, size and modification time, so a file is only read once.
+        """
+        filename = getattr(data, 'filename', None)
+        if filename is not None:
+            stat = os.stat(filename)
+            file_key = "{}:{}:{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+            index = self._read_index()
+            if file_key in index['fingerprints']:
+                return index['fingerprints'][file_key]
+
+        h = hashlib.sha1(repr((data.dtype.str, data.shape)).encode())
+        flat = data.reshape(-1)
+        for start in range(0, len(flat), chunk_size):
+            h.update(np.ascontiguousarray(flat[start:start + chunk_size]).tobytes())
+        digest = h.hexdigest()
+
+        if filename is not None:
+            index = self._read_index()
+            index['fingerprints'][file_key] = digest
+            self._write_index(index)
+        return digest
+
+    def size(self):
+        """Returns the total size of all entries in bytes."""
+        return sum(e['size'] for e in self._read_index()['entries'].values())
+
+
+
+    ##### Private methods
+
+    def _evict(self, index, keep):
+        if self.max_bytes is None:
+            return
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for k in sorted(entries, key=lambda k: entries[k]['used']):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            print("Evicting cache entry {} ({} bytes)".format(k, entries[k]['size']))
+            shutil.rmtree(os.path.join(self.directory, k), ignore_errors=True)
+            total -= entries[k]['size']
+            del entries[k]
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'entries': {}, 'fingerprints': {}}
+
+    def _write_index(self, index):
+        tmp = "{}.tmp{}".format(self.index_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_file)
@@ -1,8 +1,15 @@
 import numpy as np
 from datetime import datetime
+import os
 import time
 
+import data
+import cache
 from csv_writer import CsvWriter
+from filters import default_cascade, FilterCascade
+from parallel import ParallelVerifier
+from result_sink import ResultSink
+from util import ensure_directory
 
 """Commands that can be called from the command line."""
 
@@ -10,61 +17,231 @@ from csv_writer import CsvWriter
 def default(pf, args, start_t):
     """Evaluates candidates, highest signature similarity first.
 
-    Results are written to the file given by args.results (--results
-    option).
-    """
+    Candidates are streamed from pf.prioritized_candidates(), so
+    verification starts before all of them have been generated, and
+    pass a cascade of cheap filters before the exact Jaccard check
+    (disable with --no-filters). With --jobs, batches are verified by
+    that many worker processes and their results merged in order.
 
-    print("Getting all candidates...")
-    t = time.time()
-    candidates = list(pf.candidates())
-    print("Done, got {} candidates in {}s".format(len(candidates), time.time() - t))
+    With --progressive, signatures and buckets are prepared band by band
+    during verification (see PairFinder.progressive_candidates()), so
+    pairs are found from the start. Pairs then come in bursts, one per
+    band, so the run only stops early when time is up.
 
-    print("Sorting candidates...")
-    t = time.time()
-    candidates = sorted(candidates, key = lambda c: -c[1])
-    print("Done in {}s".format(time.time() - t))
+    Results are written to the file given by args.results (--results
+    option) in a background thread, which also keeps a checkpoint next
+    to it (see result_sink.py). With --resume, a killed run continues
+    from its checkpoint, without verifying candidates again.
+    """
 
     csv_file = args.results if 'results' in args else 'results.txt'
     append_results = not args.dont_append_results if 'dont_append_results' in args else True
     extended_results = args.extended if 'extended' in args else False
-
-    csv = CsvWriter(csv_file, append=append_results)
+    use_filters = not args.no_filters if 'no_filters' in args else True
+    progressive = args.progressive if 'progressive' in args else False
+    resume = args.resume if 'resume' in args else False
+
+    # the candidate stream only depends on these
+    data_stat = os.stat(args.data) if 'data' in args and os.path.exists(args.data) else None
+    stream_key = cache.key('results', args.seed if 'seed' in args else None,
+                           data_stat and (args.data, data_stat.st_size, data_stat.st_mtime_ns),
+                           pf.sig_len, pf.n_bands, pf.signature_method, pf.bbits,
+                           pf.max_bucket_size, progressive, use_filters, extended_results)
+    sink = ResultSink(csv_file, append=append_results, key=stream_key, resume=resume)
+    cascade = default_cascade(pf, .5) if use_filters else FilterCascade([])
 
     print("Verifying candidates...")
     found = 0
-    found_times = np.array([])
-    for i, ((c1, c2), sim) in enumerate(candidates):
-        jac_sim = pf.jaccard_similarity(c1, c2)
-        elapsed_t = time.time() - start_t
-
-        if jac_sim > .5:
-            c1, c2 = min(c1, c2) + 1, max(c1, c2) + 1
+    found_times = []
+    i = sink.cursor
+    verified = 0
+    elapsed_t = time.time() - start_t
+    jobs = args.jobs if 'jobs' in args else 1
+    batches = _filtered_batches(pf, cascade, progressive, sink, skip=sink.cursor)
+    with ParallelVerifier(pf, jobs) as verifier, sink:
+        for (c1s, c2s, sims, pos, n), jac_sims in verifier.map(batches):
+            verified += len(c1s)
+            i += n
+            elapsed_t = time.time() - start_t
+
+            similar = np.nonzero(jac_sims > .5)[0]
             if extended_results:
-                csv.write([c1, c2, sim, jac_sim, i, elapsed_t])
+                rows = [[int(c1s[k]) + 1, int(c2s[k]) + 1, sims[k], jac_sims[k], pos[k], elapsed_t]
+                        for k in similar]
             else:
-                csv.write([c1, c2])
-            found += 1
-            found_times = np.append(found_times, time.time() - start_t)
-            print("Found {} (at signature similarity {}, after {}s)".format(found, sim, elapsed_t), end = '\r')
-
-        # stop when 30 minutes are over
-        if elapsed_t > 1800 - 2:
-            print("\nTime's up, stopping.")
-            break
-
-        # every 100 candidates, check whether rate is so low we should stop
-        if found >= 100 and i % 100 == 0:
-            if elapsed_t - found_times[-10] > 60: # less than 10 per minute
-                print("\nRate is slowing down, stopping.")
+                rows = [[int(c1s[k]) + 1, int(c2s[k]) + 1] for k in similar]
+            sink.write(rows, c1s[similar], c2s[similar], i)
+
+            for k in similar:
+                found += 1
+                found_times.append(elapsed_t)
+                print("Found {} (at signature similarity {}, after {}s)".format(found, sims[k], elapsed_t), end = '\r')
+
+            # stop when 30 minutes are over
+            if elapsed_t > 1800 - 2:
+                print("\nTime's up, stopping.")
                 break
 
+            # check whether rate is so low we should stop
+            if found >= 100 and not progressive:
+                if elapsed_t - found_times[-10] > 60: # less than 10 per minute
+                    print("\nRate is slowing down, stopping.")
+                    break
+
     print("Finished in {}s.".format(elapsed_t))
+    cascade.print_stats()
+    print("Verified {} of {} candidates.".format(verified, i))
     print("Found {} pairs, {} per minute.".format(found, found / elapsed_t * 60))
 
 
     return True
 
 
+def update(pf, args, start_t):
+    """Adds new ratings and verifies only the pairs that became candidates.
+
+    The ratings are read from args.new_rows (same format as the data) and
+    found pairs are appended to args.results. If an index file is used
+    (--index), it is replaced by the updated state.
+    """
+    new_rows = data.load(args.new_rows)
+    if pf.signature_method != 'minhash' and np.max(new_rows[:, 1]) - pf.first_id >= pf.n_shingles:
+        print("New movies are only supported with minhash signatures")
+        return False
+
+    csv = CsvWriter(args.results, append=True)
+    cascade = default_cascade(pf, .5)
+
+    found = 0
+    verified = 0
+    for c1s, c2s, sims in pf.update(new_rows):
+        idx = np.nonzero(cascade(pf, c1s, c2s, sims))[0]
+        jac_sims = pf.verify_batch(c1s[idx], c2s[idx])
+        verified += len(idx)
+
+        for k in np.nonzero(jac_sims > .5)[0]:
+            csv.write([int(c1s[idx[k]]) + 1, int(c2s[idx[k]]) + 1])
+            found += 1
+
+    cascade.print_stats()
+    print("Verified {} candidates.".format(verified))
+    print("Found {} new pairs in {}s.".format(found, time.time() - start_t))
+
+    if args.index:
+        pf.save_index(args.index)
+    return True
+
+
+def knn_graph(pf, args, start_t):
+    """Finds the k most similar users of every user.
+
+    The graph is stored in CSR form in args.results (.npz with indptr,
+    indices and similarities). Row i holds the neighbours of the user
+    with ID i + first_id, most similar first, as 0-based indices.
+    """
+    from knn import knn_graph
+
+    t = time.time()
+    top = knn_graph(pf, args.k)
+    elapsed_t = time.time() - t
+
+    indptr, indices, similarities = top.to_csr()
+    ensure_directory(f=args.results)
+    np.savez(args.results, indptr=indptr, indices=indices, similarities=similarities,
+             first_id=pf.first_id)
+
+    counts = np.diff(indptr)
+    print("{} of {} users have {} neighbours, {} have none.".format(
+        np.sum(counts == args.k), pf.n_docs, args.k, np.sum(counts == 0)))
+    print("Processed {} users per second.".format(pf.n_docs / elapsed_t))
+    return True
+
+
+def sharded(pf, args, start_t):
+    """Finds pairs with band-sharded map and reduce tasks on this machine.
+
+    Runs --shards map and --partitions reduce tasks with --jobs
+    processes (see sharded.py) and writes the pairs to args.results.
+    """
+    import sharded
+
+    found = sharded.run(pf, args.dir, args.shards, args.partitions, args.jobs, args.results)
+    elapsed_t = time.time() - start_t
+    print("Found {} pairs in {}s, {} per minute.".format(found, elapsed_t, found / elapsed_t * 60))
+    return True
+
+
+def shard_map(pf, args, start_t):
+    """Runs one map task of the band-sharded mode.
+
+    Every node needs the same data, seed and parameters, and access to
+    --dir.
+    """
+    import sharded
+
+    sharded.map_shard(pf, args.shard, args.shards, args.dir, args.partitions)
+    return True
+
+
+def shard_reduce(pf, args, start_t):
+    """Runs one reduce task of the band-sharded mode, after all map tasks."""
+    import sharded
+
+    sharded.reduce_partition(pf, args.partition, args.shards, args.dir)
+    return True
+
+
+def serve(pf, args, start_t):
+    """Answers similarity queries on a local socket until interrupted.
+
+    See server.py for the protocol.
+    """
+    from server import QueryServer
+
+    server = QueryServer(pf, (args.host, args.port))
+    print("Ready after {}s, serving on {}:{}".format(time.time() - start_t, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        server.server_close()
+    print("Verified {} pairs in {} batches.".format(server.verifier.pairs, server.verifier.batches))
+    return True
+
+
+def _filtered_batches(pf, cascade, progressive = False, sink = None, skip = 0):
+    """Yields the prioritized candidates that pass the cascade.
+
+    With progressive, candidates come from
+    PairFinder.progressive_candidates() and the signature bound of the
+    cascade is based on the number of signature rows computed so far.
+    The first skip candidates and the pairs already confirmed by sink
+    are skipped.
+
+    Yields:
+        tuple: (c1, c2, similarity, position in the candidate stream,
+            number of candidates before filtering) per batch.
+    """
+    if progressive:
+        candidates = pf.progressive_candidates()
+    else:
+        candidates = ((c1s, c2s, sims, None) for c1s, c2s, sims in pf.prioritized_candidates())
+
+    i = 0
+    for c1s, c2s, sims, rows in candidates:
+        if i + len(c1s) <= skip:
+            i += len(c1s)
+            continue
+
+        keep = cascade(pf, c1s, c2s, sims, rows)
+        if sink is not None:
+            keep &= ~sink.is_confirmed(c1s, c2s)
+        idx = np.nonzero(keep)[0]
+        yield c1s[idx], c2s[idx], sims[idx], i + idx, len(c1s)
+        i += len(c1s)
+
+
 def console(pf, args, start_t):
     """Simply opens a prompt after preparing the algorithm."""
     import code; code.interact(local=dict(globals(), **locals()))
@@ -79,7 +256,11 @@ def get_candidate_distribution(pf, args, start_t):
     the stratum than max_per_step, to get approximately accurate
     frequencies).
     """
-    candidates = list(pf.candidates())
+    batches = list(pf.candidate_batches())
+    if not batches:
+        print("No candidates to sample from")
+        return True
+    c1s, c2s, sims = [np.concatenate(a) for a in zip(*batches)]
 
     csv_file = args.results
     csv = CsvWriter(csv_file, append = True)
@@ -90,20 +271,22 @@ def get_candidate_distribution(pf, args, start_t):
         'weight'])
 
     run_id = datetime.now().isoformat()
+    used_buckets = pf.count_buckets() if pf.n_bands else 'NA'
 
     lim = 0; step = 0.05; max_per_step = 100
     while lim < 1:
-        cand = [(c, sim) for c, sim in candidates if sim >= lim and sim < lim + step]
+        cand = np.nonzero((sims >= lim) & (sims < lim + step))[0]
         n = len(cand)
         print("{} candidates between {} and {}".format(n, lim, lim+step))
 
         weight = max(n, max_per_step) / max_per_step
-        for i in np.random.permutation(n)[:max_per_step]:
-            (c1, c2), sim = cand[i]
+        sample = cand[np.random.permutation(n)[:max_per_step]]
+        jac_sims = pf.verify_batch(c1s[sample], c2s[sample])
+        for c1, c2, sim, jac_sim in zip(c1s[sample], c2s[sample], sims[sample], jac_sims):
             csv.write([
                 run_id,
-                c1, c2, sim, pf.jaccard_similarity(c1, c2),
-                pf.sig_len, pf.n_bands, pf.max_buckets, len(pf.buckets),
+                c1, c2, sim, jac_sim,
+                pf.sig_len, pf.n_bands, 'NA', used_buckets,
                 weight])
 
         lim += step
@@ -120,11 +303,17 @@ def get_jaccard_distribution(pf, args, start_t):
     csv = CsvWriter(args.results, append = True)
     csv.write_header(['u1', 'u2', 'jac_sim', 'sig_sim'])
 
-    for i, (u1, u2) in enumerate(zip(np.random.permutation(pf.n_docs),
-                                     np.random.permutation(pf.n_docs))):
-        if u1 == u2: next
-        print("Wrote {} similarities".format(i), end = '\r')
-        csv.write([u1, u2, pf.jaccard_similarity(u1, u2), pf.sig_sim(u1, u2)])
+    u1s = np.random.permutation(pf.n_docs)
+    u2s = np.random.permutation(pf.n_docs)
+    different = u1s != u2s
+    u1s, u2s = u1s[different], u2s[different]
+
+    batch_size = 10000
+    for start in range(0, len(u1s), batch_size):
+        u1, u2 = u1s[start:start + batch_size], u2s[start:start + batch_size]
+        for row in zip(u1, u2, pf.verify_batch(u1, u2), pf.sig_sim(u1, u2)):
+            csv.write(row)
+        print("Wrote {} similarities".format(start + len(u1)), end = '\r')
 
     return True
 
@@ -149,4 +338,16 @@ def benchmark(pf, args, start_t):
             pf.jaccard_similarity(i1[i], i2[i])
         print("Done in {}s".format(time.time() - t))
 
+    if run_all or args.run == 'verify_batch':
+        i1 = np.random.permutation(pf.n_docs)[:100000]
+        i2 = np.random.permutation(pf.n_docs)[:100000]
+
+        print("Burn in...")
+        pf.verify_batch(i1[:1000], i2[:1000])
+
+        print("Start... ")
+        t = time.time()
+        pf.verify_batch(i1, i2)
+        print("Done in {}s ({} pairs)".format(time.time() - t, len(i1)))
+
     return True
@@ -1,6 +1,68 @@
 import numpy as np
-import pandas as pd
+
+
+"""Loading of the ratings without copying them.
+
+The ratings file is memory-mapped, and matrices are built from it with
+a counting sort over chunks of ratings. IDs are shifted to start at 0
+chunk by chunk, so the ratings are never copied as a whole.
+"""
 
 
 def load(filename = "user_movie.npy"):
-    return pd.DataFrame(np.load(filename), columns=("user", "movie"))
+    """Memory-maps the ratings.
+
+    Returns:
+        numpy.ndarray: Read-only array with one row (user ID, movie ID)
+            per rating. IDs start at 1.
+    """
+    return np.load(filename, mmap_mode='r')
+
+
+def to_csr(rows, cols, n_rows, first_id = 1, chunk_size = 2**24, indices = None):
+    """Builds the structure of a binary CSR matrix from (row, column) IDs.
+
+    The rows are counted with bincount, their starts are the cumulative
+    sum of the counts, and every chunk of entries is then scattered to
+    its rows.
+
+    Args:
+        rows (numpy.ndarray): Row ID of every entry (may be memory-mapped).
+        cols (numpy.ndarray): Column ID of every entry.
+        n_rows (int): Number of rows.
+        first_id (int): ID of the first row and column, subtracted
+            from all IDs.
+        chunk_size (int): Number of entries processed at once.
+        indices (numpy.ndarray, optional): int32 array of len(rows) to
+            write the column indices to, e.g. memory-mapped. Default: a
+            new array.
+
+    Returns:
+        tuple: (indptr, indices). Column indices within a row keep the
+            order of the input, so they are not necessarily sorted.
+    """
+    n = len(rows)
+    counts = np.zeros(n_rows, dtype=np.int64)
+    for start in range(0, n, chunk_size):
+        counts += np.bincount(rows[start:start + chunk_size] - first_id, minlength=n_rows)
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    del counts
+
+    if indices is None:
+        indices = np.empty(n, dtype=np.int32)
+    cursor = indptr[:-1].copy()
+    for start in range(0, n, chunk_size):
+        r = rows[start:start + chunk_size] - first_id
+        c = cols[start:start + chunk_size] - first_id
+
+        order = np.argsort(r, kind='mergesort')
+        r, c = r[order], c[order]
+
+        # position of every entry among the entries of its row in this chunk
+        rank = np.arange(len(r)) - np.searchsorted(r, r)
+        indices[cursor[r] + rank] = c
+        cursor += np.bincount(r, minlength=n_rows)
+
+    return indptr, indices
@@ -18,9 +18,9 @@ as a CSV.
 csv = CsvWriter("diagnostics/out/evaluation.csv", append = True)
 csv.write_header(['note', 'batch', 'run', 'found', 'incorrect', 'time', 'ppm', 'terminated'])
 
-def jaccard_sim(data, u1, u2):
-    m1 = data.movie[data.user == u1]
-    m2 = data.movie[data.user == u2]
+def jaccard_sim(ratings, u1, u2):
+    m1 = ratings[ratings[:, 0] == u1, 1]
+    m2 = ratings[ratings[:, 0] == u2, 1]
     return len(np.intersect1d(m1, m2)) / len(np.union1d(m1, m2))
 
 
@@ -66,7 +66,7 @@ def run_evaluation(note, batch = 0, runs = 5):
             incorrect = 0
 
             if os.path.exists("results.txt"):
-                df = data.load()
+                ratings = data.load()
 
                 with open("results.txt") as f:
                     for l in f:
@@ -74,12 +74,12 @@ def run_evaluation(note, batch = 0, runs = 5):
                         u1, u2 = int(u1), int(u2)
                         if u1 >= u2:
                             incorrect += 1
-                        elif jaccard_sim(df, u1, u2) <= 0.5:
+                        elif jaccard_sim(ratings, u1, u2) <= 0.5:
                             incorrect += 1
                         else:
                             found += 1
 
-                del df
+                del ratings
                 gc.collect()
 
             csv.write([
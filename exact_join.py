@@ -0,0 +1,206 @@
+import numpy as np
+from scipy import sparse
+import time
+
+from pair_finder import PairFinder
+
+
+"""Exact similarity join using prefix filtering (AllPairs/PPJoin).
+
+Shingles are ordered by increasing global frequency and every document
+keeps only the prefix of its rarest shingles that any document with
+Jaccard similarity >= threshold must share with it. Pairs sharing a
+prefix shingle are the candidates, pruned by the length filter and the
+positional filter of PPJoin. Unlike MinHash/LSH, no pair above the
+threshold is ever missed.
+
+All steps are vectorized: the prefix entries are grouped by shingle like
+LSH buckets, and co-occurrences are generated for a range of first
+documents at a time, so that all co-occurrences of a pair end up in the
+same partition and can be counted there.
+
+Args:
+    data (numpy.ndarray): Array with two columns (document IDs, shingle
+        IDs).
+    threshold (float): Jaccard similarity the candidates have to be able
+        to reach.
+    use_sparse (bool): See PairFinder.
+    use_bits (bool): See PairFinder.
+    batch_size (int): Maximum number of co-occurrences generated at
+        once (unless a single document has more).
+    first_id (int): ID of the first document and shingle in data.
+"""
+
+
+class ExactPairFinder(PairFinder):
+    """Exact prefix-filtering join with the same interface as PairFinder."""
+
+    def __init__(self, data, threshold=0.5, use_sparse=False, use_bits=False,
+                 batch_size=2**22, first_id=1):
+        self._set_data(data, first_id)
+        self.threshold = threshold
+        self.sparse_ds = use_sparse or use_bits
+        self.bits_ds = use_bits
+        self.batch_size = batch_size
+
+        # no signatures
+        self.sig_len = None
+        self.n_bands = None
+        self.signature_method = None
+        self.bbits = None
+        self.max_bucket_size = None
+
+    def prepare(self):
+        """Initialize everything that's required."""
+        self.prepare_matrices()
+        self._build_prefix_index()
+
+    def candidate_batches(self, threshold = 0.0, batch_size = None):
+        """Yields all candidate pairs in batches of numpy arrays.
+
+        The similarity of a candidate is the upper bound of its Jaccard
+        similarity from the positional filter.
+
+        Args:
+            threshold (float): Require this similarity bound for a candidate to be yielded.
+            batch_size (int, optional): Maximum number of co-occurrences
+                to process at once. Default: batch_size of the constructor.
+
+        Yields:
+            tuple: (c1, c2, similarity bound) arrays, with c1 < c2.
+        """
+        partitions = self._partitions(batch_size or self.batch_size)
+        t = time.time()
+
+        for p in range(len(partitions) - 1):
+            lo, hi = partitions[p], partitions[p + 1]
+            c1, c2, bound = self._join_partition(lo, hi)
+            keep = bound >= threshold
+            yield c1[keep], c2[keep], bound[keep]
+
+            print("  {}/{} partitions done in {}s".format(
+                p + 1, len(partitions) - 1, time.time() - t), end = '\r')
+
+    def prioritized_candidates(self, threshold = 0.0, batch_size = None):
+        """Streams candidate batches, every batch sorted by decreasing similarity bound."""
+        for c1, c2, bound in self.candidate_batches(threshold, batch_size):
+            order = np.argsort(-bound, kind='mergesort')
+            yield c1[order], c2[order], bound[order]
+
+    def count_candidates(self):
+        """Returns the number of prefix co-occurrences, an upper bound of the number of candidates."""
+        return int(np.sum(self.pair_counts))
+
+    def sig_sim(self, i, j):
+        """Returns the exact Jaccard similarity, as there are no signatures."""
+        return self.verify_batch(np.atleast_1d(i), np.atleast_1d(j)).reshape(np.shape(i))
+
+    def print_stats(self):
+        """Prints useful stats for model diagnostics."""
+        print("{} prefix entries of {} ratings".format(len(self.prefix_docs), self.DU.nnz))
+        print("Up to {} candidate pairs in {} partitions".format(
+            self.count_candidates(), len(self._partitions(self.batch_size)) - 1))
+
+
+
+    ##### Private methods
+
+    def _build_prefix_index(self):
+        print("Building prefix index...")
+        t = time.time()
+
+        # rank shingles by increasing frequency, rarest first
+        freq = np.bincount(self.DU.indices, minlength=self.DU.shape[1])
+        rank = np.empty(len(freq), dtype=np.int64)
+        rank[np.argsort(freq, kind='mergesort')] = np.arange(len(freq))
+
+        ranked = sparse.csr_matrix(
+            (self.DU.data, rank[self.DU.indices], self.DU.indptr), shape=self.DU.shape)
+        ranked.sort_indices()
+
+        sizes = self.doc_sizes
+        docs = np.repeat(np.arange(len(sizes)), sizes)
+        pos = np.arange(ranked.nnz) - np.repeat(ranked.indptr[:-1], sizes)
+
+        # a document with similarity >= t to this one has to share one of
+        # its first l - ceil(t * l) + 1 shingles
+        prefix_len = sizes - np.ceil(self.threshold * sizes - 1e-9).astype(np.int64) + 1
+        prefix_len = np.minimum(prefix_len, sizes)
+        in_prefix = pos < prefix_len[docs]
+
+        # group prefix entries by shingle, documents ascending within a group
+        tokens = ranked.indices[in_prefix]
+        docs = docs[in_prefix]
+        order = np.lexsort((docs, tokens))
+        tokens, self.prefix_docs, self.prefix_pos = tokens[order], docs[order], pos[in_prefix][order]
+
+        starts = np.ones(len(tokens), dtype=bool)
+        starts[1:] = tokens[1:] != tokens[:-1]
+        starts = np.nonzero(starts)[0]
+        ends = np.append(starts[1:], len(tokens))
+        ends = np.repeat(ends, ends - starts)
+
+        # co-occurrences in which an entry is the first document
+        self.pair_counts = ends - np.arange(len(tokens)) - 1
+
+        # entries ordered by first document, and co-occurrences up to
+        # every document for partitioning
+        self.by_doc = np.argsort(self.prefix_docs, kind='mergesort')
+        self.doc_starts = np.searchsorted(self.prefix_docs[self.by_doc], np.arange(len(sizes) + 1))
+        per_doc = np.bincount(self.prefix_docs, weights=self.pair_counts, minlength=len(sizes))
+        self.pairs_cum = np.cumsum(per_doc)
+
+        print("Done in {}s".format(time.time() - t))
+
+    def _partitions(self, batch_size):
+        """Returns the bounds of ranges of documents with at most batch_size co-occurrences each."""
+        cum = self.pairs_cum
+        bounds = np.searchsorted(cum, np.arange(batch_size, cum[-1] if len(cum) else 0, batch_size))
+        return np.unique(np.concatenate([[0], bounds, [len(cum)]]))
+
+    def _join_partition(self, lo, hi):
+        """Returns the candidates whose first document is in [lo, hi)."""
+        sel = self.by_doc[self.doc_starts[lo]:self.doc_starts[hi]]
+        counts = self.pair_counts[sel]
+        cum = np.cumsum(counts)
+        total = int(cum[-1]) if len(cum) > 0 else 0
+
+        k = np.arange(total, dtype=np.int64)
+        first = np.searchsorted(cum, k, side='right')
+        second = sel[first] + 1 + k - (cum[first] - counts[first])
+        first = sel[first]
+        del k
+
+        x, y = self.prefix_docs[first], self.prefix_docs[second]
+        lx, ly = self.doc_sizes[x], self.doc_sizes[y]
+
+        # length filter
+        keep = np.minimum(lx, ly) >= self.threshold * np.maximum(lx, ly) - 1e-9
+        x, y, first, second = x[keep], y[keep], first[keep], second[keep]
+
+        # count shared prefix shingles per pair
+        key = (x.astype(np.uint64) << np.uint64(32)) | y.astype(np.uint64)
+        order = np.argsort(key, kind='mergesort')
+        key, first, second = key[order], first[order], second[order]
+
+        starts = np.ones(len(key), dtype=bool)
+        starts[1:] = key[1:] != key[:-1]
+        starts = np.nonzero(starts)[0]
+        if len(starts) == 0:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, np.array([], dtype=float)
+        overlap = np.diff(np.append(starts, len(key)))
+        last_i = np.maximum.reduceat(self.prefix_pos[first], starts)
+        last_j = np.maximum.reduceat(self.prefix_pos[second], starts)
+
+        c1, c2 = self.prefix_docs[first[starts]], self.prefix_docs[second[starts]]
+        l1, l2 = self.doc_sizes[c1], self.doc_sizes[c2]
+
+        # positional filter: shared shingles after the last shared prefix
+        # shingle are bounded by what is left of the shorter remainder
+        bound = overlap + np.minimum(l1 - last_i - 1, l2 - last_j - 1)
+        required = np.ceil(self.threshold / (1 + self.threshold) * (l1 + l2) - 1e-9)
+        keep = bound >= required
+
+        c1, c2, bound = c1[keep], c2[keep], bound[keep]
+        return c1, c2, bound / (self.doc_sizes[c1] + self.doc_sizes[c2] - bound)
@@ -60,7 +60,7 @@ def perform(params):
             if count != last_count:
                 print("Run {}   Count at {}s: {}".format(run_id, int(elapsed), count))
                 csv.write([batch_id, run_id,
-                           params['bands'], params['rows'], params['max-buckets'],
+                           params['bands'], params['rows'], 'NA',
                            elapsed, count])
                 last_count = count
 
@@ -82,21 +82,19 @@ def main(args):
     grid = list(ParameterGrid({
         'bands': [18, 19, 20, 21, 22, 23, 24, 25, 26],
         'rows' : [6],
-        'max-buckets': [5000000],
     })) * 40
     # grid = []
 
     # candidates = [
-    #     {'bands': 30, 'rows': 6, 'max-buckets': 2800000},
-    #     {'bands': 27, 'rows': 6, 'max-buckets': 2800000},
-    #     {'bands': 32, 'rows': 7, 'max-buckets': 2800000},
+    #     {'bands': 30, 'rows': 6},
+    #     {'bands': 27, 'rows': 6},
+    #     {'bands': 32, 'rows': 7},
     # ]
     # for i in range(1000):
     #     # grid += candidates
     #     grid.append({
     #         'bands': np.random.randint(3, 35),
     #         'rows': np.random.randint(3, 35),
-    #         'max-buckets': 2800000,
     #     })
 
     # sensible limit for sig len
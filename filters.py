@@ -0,0 +1,118 @@
+import numpy as np
+
+
+"""Cheap filters that drop hopeless candidates before exact verification.
+
+A filter is called with the PairFinder, the candidate pairs (c1, c2),
+their signature similarities and optionally the number of signature
+rows the similarities are estimated from, and returns a boolean array
+of the pairs to keep. Filters must never drop a pair whose Jaccard similarity
+is (with high probability) above the threshold.
+"""
+
+
+class SizeRatioFilter:
+    """Drops pairs whose set sizes are too different.
+
+    J(A, B) <= min(|A|, |B|) / max(|A|, |B|), so a pair can only exceed
+    the threshold if its size ratio does.
+    """
+
+    name = "size ratio"
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def __call__(self, pf, c1, c2, sim, rows=None):
+        s1 = pf.doc_sizes[c1]
+        s2 = pf.doc_sizes[c2]
+        return np.minimum(s1, s2) > self.threshold * np.maximum(s1, s2)
+
+
+class SignatureBoundFilter:
+    """Drops pairs whose signature similarity is implausibly low.
+
+    The signature similarity estimates the Jaccard similarity from
+    sig_len samples. Pairs are kept if the upper Wilson score bound of
+    that estimate (with z standard deviations) is above the threshold.
+
+    With b-bit signatures, the similarity is the estimate corrected for
+    accidental agreement, R = (P - 2^-b) / (1 - 2^-b), which varies
+    more than the fraction P of agreeing values. The bound is computed
+    on P and then corrected the same way.
+
+    Similarities estimated from only the first rows signature rows, with
+    full values (see PairFinder.progressive_candidates()), are bounded
+    with rows samples and no correction.
+    """
+
+    name = "signature bound"
+
+    def __init__(self, threshold, sig_len, z=3.0, bbits=None):
+        self.threshold = threshold
+        self.sig_len = sig_len
+        self.z = z
+        self.bbits = bbits
+
+    def __call__(self, pf, c1, c2, sim, rows=None):
+        if rows is not None:
+            return self._upper(sim, rows) > self.threshold
+        if not self.bbits:
+            return self._upper(sim, self.sig_len) > self.threshold
+        chance = 2.0 ** -self.bbits
+        upper = self._upper(sim * (1 - chance) + chance, self.sig_len)
+        return (upper - chance) / (1 - chance) > self.threshold
+
+
+
+    ##### Private methods
+
+    def _upper(self, p, n):
+        z = self.z
+        center = p + z**2 / (2 * n)
+        spread = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+        return (center + spread) / (1 + z**2 / n)
+
+
+class FilterCascade:
+    """Applies filters in order and counts how many pairs each one keeps.
+
+    Args:
+        filters (list): Filters, cheapest first.
+    """
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.kept = [0] * len(filters)
+        self.dropped = [0] * len(filters)
+
+    def __call__(self, pf, c1, c2, sim, rows=None):
+        """Returns a boolean array of the pairs that pass all filters.
+
+        rows, if given, is the number of signature rows sim is estimated
+        from, if not all of them.
+        """
+        keep = np.ones(len(c1), dtype=bool)
+        for k, f in enumerate(self.filters):
+            idx = np.nonzero(keep)[0]
+            passed = f(pf, c1[idx], c2[idx], sim[idx], rows)
+            keep[idx[~passed]] = False
+            self.kept[k] += int(np.sum(passed))
+            self.dropped[k] += int(len(idx) - np.sum(passed))
+        return keep
+
+    def print_stats(self):
+        """Prints how many pairs every filter kept and dropped."""
+        for f, kept, dropped in zip(self.filters, self.kept, self.dropped):
+            print("Filter {}: kept {}, dropped {}".format(f.name, kept, dropped))
+
+
+def default_cascade(pf, threshold):
+    """Returns the default cascade for finding pairs above threshold.
+
+    The signature bound is only used if pf has signatures.
+    """
+    filters = [SizeRatioFilter(threshold)]
+    if pf.sig_len:
+        filters.append(SignatureBoundFilter(threshold, pf.sig_len, bbits=pf.bbits))
+    return FilterCascade(filters)
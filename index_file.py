@@ -0,0 +1,86 @@
+import numpy as np
+import json
+import os
+import struct
+
+
+"""Single-file storage of named arrays, opened with memory mapping.
+
+The file starts with a magic string, the format version and the length
+of a JSON header, followed by the header and the raw array data. The
+header holds arbitrary metadata and the dtype, shape and offset of
+every array. Arrays start at multiples of ALIGNMENT bytes, so they can
+be viewed in place from a single read-only mapping of the file, which
+the OS shares between all processes opening it.
+"""
+
+
+MAGIC = b"NFLXLSH\0"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def save(filename, arrays, meta):
+    """Writes arrays and metadata to filename.
+
+    Args:
+        filename (string): File to write.
+        arrays (dict): Arrays by name.
+        meta (dict): JSON-serializable metadata.
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += _aligned(array.nbytes)
+
+    header = json.dumps({'meta': meta, 'arrays': layout}).encode()
+    start = _aligned(len(MAGIC) + 12 + len(header))
+
+    # write next to the file and replace it at the end, so that processes
+    # (including this one) that mapped the old file can keep using it
+    tmp = "{}.tmp{}".format(filename, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<IQ", VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).data)
+        f.truncate(start + offset)
+    os.replace(tmp, filename)
+
+
+def load(filename):
+    """Opens a file written by save().
+
+    Returns:
+        tuple: (arrays, meta), with read-only arrays mapping the file.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise Exception("{} is not an index file".format(filename))
+        version, header_len = struct.unpack("<IQ", f.read(12))
+        if version != VERSION:
+            raise Exception("{} has index format version {}, expected {}".format(
+                filename, version, VERSION))
+        header = json.loads(f.read(header_len).decode())
+
+    start = _aligned(len(MAGIC) + 12 + header_len)
+    raw = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    arrays = {}
+    for name, a in header['arrays'].items():
+        dtype = np.dtype(a['dtype'])
+        begin = start + a['offset']
+        end = begin + dtype.itemsize * int(np.prod(a['shape'], dtype=np.int64))
+        arrays[name] = raw[begin:end].view(dtype).reshape(a['shape'])
+    return arrays, header['meta']
+
+
+
+##### Private functions
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
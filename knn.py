@@ -0,0 +1,122 @@
+import numpy as np
+import time
+
+from buckets import BucketTable, signature_keys
+
+
+"""k-nearest-neighbour graph of all documents by Jaccard similarity.
+
+Candidates come from the LSH buckets and are verified in batches. Every
+document keeps its k most similar candidates in a bounded top-k table.
+Documents that end up with fewer than k neighbours are probed again
+with shorter bands (the first half of the rows of every band), which
+makes collisions more likely, until they are complete or the bands are
+a single row long.
+"""
+
+
+class TopK:
+    """Bounded table of the k most similar neighbours of every document.
+
+    Attributes:
+        neighbours (numpy.ndarray): Neighbour IDs, shape (n_docs, k),
+            most similar first, -1 for empty slots.
+        similarities (numpy.ndarray): Their similarities, -1 for empty
+            slots.
+    """
+
+    def __init__(self, n_docs, k):
+        self.k = k
+        self.neighbours = np.full((n_docs, k), -1, dtype=np.int32)
+        self.similarities = np.full((n_docs, k), -1, dtype=np.float32)
+
+    def push(self, c1, c2, sim):
+        """Offers the pairs (c1[i], c2[i]) with similarity sim[i] to both documents."""
+        docs = np.concatenate([c1, c2])
+        others = np.concatenate([c2, c1])
+        sims = np.concatenate([sim, sim]).astype(np.float32)
+
+        # merge with the current entries of all affected documents
+        touched = np.unique(docs)
+        current = self.similarities[touched] >= 0
+        docs = np.concatenate([np.repeat(touched, self.k)[current.ravel()], docs])
+        others = np.concatenate([self.neighbours[touched][current], others])
+        sims = np.concatenate([self.similarities[touched][current], sims])
+
+        order = np.lexsort((others, -sims, docs))
+        docs, others, sims = docs[order], others[order], sims[order]
+        distinct = np.ones(len(docs), dtype=bool)
+        distinct[1:] = (docs[1:] != docs[:-1]) | (others[1:] != others[:-1])
+        docs, others, sims = docs[distinct], others[distinct], sims[distinct]
+
+        rank = np.arange(len(docs)) - np.searchsorted(docs, docs)
+        keep = rank < self.k
+        self.neighbours[touched] = -1
+        self.similarities[touched] = -1
+        self.neighbours[docs[keep], rank[keep]] = others[keep]
+        self.similarities[docs[keep], rank[keep]] = sims[keep]
+
+    def counts(self):
+        """Returns the number of neighbours of every document."""
+        return np.sum(self.similarities >= 0, axis=1)
+
+    def to_csr(self):
+        """Returns (indptr, indices, similarities) with the neighbours of every document."""
+        valid = self.similarities >= 0
+        indptr = np.zeros(len(valid) + 1, dtype=np.int64)
+        np.cumsum(np.sum(valid, axis=1), out=indptr[1:])
+        return indptr, self.neighbours[valid], self.similarities[valid]
+
+
+def knn_graph(pf, k, batch_size = 2**18, max_probe_bucket = 1000):
+    """Finds the k most similar documents of every document.
+
+    Args:
+        pf (PairFinder): Prepared pair finder.
+        k (int): Number of neighbours per document.
+        batch_size (int): Number of candidate pairs verified at once.
+        max_probe_bucket (int): When probing shorter bands, ignore
+            buckets with more members. They hold documents sharing only
+            a few frequent shingles, and would make probing quadratic.
+
+    Returns:
+        TopK: The neighbours of every document.
+    """
+    top = TopK(pf.n_docs, k)
+
+    print("Verifying candidates...")
+    t = time.time()
+    n = 0
+    for c1, c2, sim in pf.candidate_batches(batch_size=batch_size):
+        _push_verified(pf, top, c1, c2)
+        n += len(c1)
+        print("  {} candidates in {}s".format(n, time.time() - t), end = '\r')
+    print("")
+
+    # probe documents with too few neighbours on shorter bands
+    rows = pf.sig_len // pf.n_bands
+    band_rows = np.arange(pf.sig_len).reshape(pf.n_bands, rows)
+    while rows > 1:
+        missing = np.nonzero(top.counts() < k)[0]
+        if len(missing) == 0:
+            break
+
+        rows //= 2
+        keys = signature_keys(pf.S[band_rows[:, :rows].ravel()], pf.n_bands)
+        c1, c2 = BucketTable(keys).pairs_with(missing, max_probe_bucket)
+        print("Probing {} documents with {} rows per band: {} candidates".format(
+            len(missing), rows, len(c1)))
+        for start in range(0, len(c1), batch_size):
+            _push_verified(pf, top, c1[start:start + batch_size], c2[start:start + batch_size])
+
+    print("Done in {}s".format(time.time() - t))
+    return top
+
+
+
+##### Private functions
+
+def _push_verified(pf, top, c1, c2):
+    jac = pf.verify_batch(c1, c2)
+    similar = jac > 0
+    top.push(c1[similar], c2[similar], jac[similar])
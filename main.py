@@ -1,9 +1,13 @@
 import numpy as np
 import time
 import gc
+import os
 
 import data
 import pair_finder
+import out_of_core
+import exact_join
+import autotune
 from util import calculate_algorithm_params
 import commands
 
@@ -19,23 +23,96 @@ def main(args):
     start_t = time.time()
 
     np.random.seed(seed=args.seed)
-    df = data.load(args.data)
 
-    # Make IDs start at 0 for easier indexing
-    df.user = df.user - 1
-    df.movie = df.movie - 1
+    if args.index and args.engine == 'exact':
+        print("--index only works with the lsh engine")
+        return False
 
-    sig_len, bands = calculate_algorithm_params(args)
-    print("Sig len: {}    bands: {}    rows: {}".format(sig_len, bands, int(sig_len/bands)))
+    if args.lsh_only and args.engine == 'exact':
+        print("This command only works with the lsh engine")
+        return False
 
-    pairfinder = pair_finder.build(
-        data=df, sig_len=sig_len, bands=bands,
-        max_buckets=args.max_buckets, cached=args.use_cache)
-    pairfinder.prepare()
-    pairfinder.print_stats()
-    print("")
+    if args.whole_buckets and args.max_bucket_size:
+        print("This command doesn't work with --max-bucket-size")
+        return False
 
-    del df
+    if 'progressive' in args and args.progressive and (args.engine == 'exact' or args.max_bucket_size
+                                                       or args.index):
+        print("--progressive only works with the lsh engine, without --max-bucket-size and --index")
+        return False
+
+    if args.autotune and args.signature_method == 'oph':
+        print("--autotune doesn't work with --signature-method oph")
+        return False
+
+    if args.memory_limit and (args.index or args.use_cache or args.engine == 'exact'):
+        print("--memory-limit only works with the lsh engine, without --index and --use-cache")
+        return False
+
+    if args.memory_limit and (args.b_bits or args.matrix == 'bits' or args.max_bucket_size):
+        print("--memory-limit doesn't work with --b-bits, --matrix bits and --max-bucket-size")
+        return False
+
+    if args.memory_limit and (args.in_memory or ('progressive' in args and args.progressive)):
+        print("This command needs the buckets in memory, it doesn't work with --memory-limit")
+        return False
+
+    if args.memory_limit and args.jobs > 1:
+        # the workers would copy the document-shingle matrix into memory
+        print("--memory-limit verifies in a single process, ignoring --jobs")
+        args.jobs = 1
+
+    if args.index and os.path.exists(args.index):
+        pairfinder = pair_finder.PairFinder.load_index(args.index)
+        print("Using index {}: sig len {}    bands: {}".format(
+            args.index, pairfinder.sig_len, pairfinder.n_bands))
+        pairfinder.print_stats()
+        print("")
+        return args.command(pairfinder, args, start_t)
+
+    ratings = data.load(args.data)
+
+    if args.engine == 'exact':
+        pairfinder = exact_join.ExactPairFinder(
+            data=ratings, threshold=.5,
+            use_sparse=args.matrix == 'sparse', use_bits=args.matrix == 'bits')
+    else:
+        if args.autotune:
+            sig_len, bands = 1, 1 # replaced by autotune below
+        else:
+            sig_len, bands = calculate_algorithm_params(args)
+            print("Sig len: {}    bands: {}    rows: {}".format(sig_len, bands, int(sig_len/bands)))
+
+        params = dict(
+            data=ratings, sig_len=sig_len, bands=bands,
+            signature_method=args.signature_method, signature_block=args.signature_block,
+            jobs=args.jobs,
+            use_sparse=args.matrix == 'sparse', use_bits=args.matrix == 'bits', bbits=args.b_bits,
+            max_bucket_size=args.max_bucket_size)
+        if args.memory_limit:
+            pairfinder = out_of_core.OutOfCorePairFinder(
+                directory=args.spill_dir, memory_limit=args.memory_limit * 2**20, **params)
+        else:
+            pairfinder = pair_finder.build(
+                cached=args.use_cache,
+                cache_size=args.cache_size * 2**20 if args.cache_size else None, **params)
+
+        if args.autotune:
+            pairfinder.prepare_matrices()
+            elapsed_t = time.time() - start_t
+            autotune.autotune(pairfinder, args.budget - elapsed_t, elapsed_t)
+
+    if args.prepare == 'matrices' or ('progressive' in args and args.progressive):
+        # the command prepares the rest itself
+        pairfinder.prepare_matrices()
+    else:
+        pairfinder.prepare()
+        if args.index:
+            pairfinder.save_index(args.index)
+        pairfinder.print_stats()
+        print("")
+
+    del ratings
     gc.collect()
 
     return args.command(pairfinder, args, start_t)
@@ -57,13 +134,56 @@ if __name__ == '__main__':
     params_group.add_argument('--sig-len', type=int, help='Signature length.')
     params_group.add_argument('--rows', type=int, help='Signature rows per band.')
     params_group.add_argument('--bands', type=int, help='Number of bands.')
-    params_group.add_argument('--max-buckets', type=int, default=5000000, help='Maximum number of buckets.')
     params_group.add_argument('--signature-method', default='minhash',
+                              choices=['minhash', 'permutation', 'oph'],
                               help='Method for generating signatures. '
-                              'One of minhash (default) and permutation.')
+                              'One of minhash (default), permutation, and oph '
+                              '(one-permutation hashing, much faster but slightly less accurate).')
+    params_group.add_argument('--b-bits', type=int, choices=[1, 2, 4, 8, 16, 32],
+                              help='Compare signatures on only this many lowest bits per value '
+                              '(b-bit minwise hashing). Default: compare full values.')
+    params_group.add_argument('--autotune', action='store_true',
+                              help='Choose signature length and bands from a sample of the data '
+                              'and measured costs, to find the most pairs per minute within --budget. '
+                              'Not with --signature-method oph.')
+    params_group.add_argument('--budget', type=float, default=1800,
+                              help='Time budget in seconds for --autotune. Default: 1800.')
+    params_group.add_argument('--max-bucket-size', type=int,
+                              help='Split buckets with more users by re-hashing them on extra '
+                              'signature rows. Default: no splitting.')
+    params_group.add_argument('--signature-block', type=int, default=4,
+                              help='Number of hash functions computed at once. '
+                              'Lower values use less memory during signature computation.')
+    params_group.add_argument('--jobs', '-j', type=int, default=1,
+                              help='Number of processes computing signatures and verifying '
+                              'candidates. Each one needs the memory of a --signature-block. Default: 1.')
+
+    parser.add_argument('--engine', default='lsh', choices=['lsh', 'exact'],
+                        help='lsh (default) finds candidates with MinHash/LSH, exact with an '
+                        'exact prefix-filtering join for Jaccard similarity >= .5 '
+                        '(ignores the algorithm parameters).')
+
+    parser.add_argument('--matrix', default='dense', choices=['dense', 'sparse', 'bits'],
+                        help='Representation of the document-shingle matrix. '
+                        'dense (default) uses one byte per entry, sparse only stores ratings, '
+                        'bits packs the rows of every user into 64-bit words (8 times smaller '
+                        'than dense, fastest verification).')
 
     parser.add_argument('--use-cache', '-c', action='store_true',
                         help='Try to load objects from previous runs, and store them for future runs.')
+    parser.add_argument('--index', metavar='FILE',
+                        help='Open the prepared algorithm from this index file if it exists '
+                        '(ignoring the data and algorithm parameters), otherwise prepare it and '
+                        'save it there. Opening an index is nearly instant. lsh engine only.')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Size cap of the cache in MiB, least recently used objects are '
+                        'removed beyond it. 0 for no cap. Default: 4096.')
+    parser.add_argument('--memory-limit', type=int, metavar='MIB',
+                        help='Work out of core: keep matrices, signatures and candidates in files '
+                        'in --spill-dir and process them in blocks of about this many MiB. '
+                        'lsh engine with sparse matrix only. Default: everything in memory.')
+    parser.add_argument('--spill-dir', default="spill",
+                        help='Directory for the files of --memory-limit. Default: spill.')
 
     parser.add_argument('seed', metavar='random-seed', type=int,
                         help='Seed for the random number generator, set once at start of the program.')
@@ -76,7 +196,8 @@ if __name__ == '__main__':
 
     # default command
     parser_default = command_parsers.add_parser('default', help=cmd_help(commands.default))
-    parser.set_defaults(command=commands.default)
+    parser.set_defaults(command=commands.default, prepare='all', lsh_only=False, in_memory=False,
+                        whole_buckets=False)
     parser_default.set_defaults(command=commands.default)
     parser_default.add_argument('--results', default="results.txt",
                                 help='File to store pairs of user IDs in.')
@@ -84,6 +205,15 @@ if __name__ == '__main__':
                                 help='Overwrite results file instead of appending.')
     parser_default.add_argument('--extended', action='store_true',
                                 help='Store more information than just the user IDs.')
+    parser_default.add_argument('--no-filters', action='store_true',
+                                help='Verify all candidates, without filtering hopeless ones first.')
+    parser_default.add_argument('--progressive', action='store_true',
+                                help='Compute signatures and buckets band by band while verifying, '
+                                'so that pairs are found from the start. Not with --index.')
+    parser_default.add_argument('--resume', action='store_true',
+                                help='Continue a killed run with the same data, seed and parameters '
+                                'from the checkpoint next to the results file, without verifying '
+                                'candidates or writing pairs again.')
 
     # candidate-dist command
     parser_candidate_dist = command_parsers.add_parser('candidate-dist',
@@ -99,6 +229,58 @@ if __name__ == '__main__':
     parser_jaccard_dist.add_argument('--results', default="diagnostics/out/jaccard_dist.csv",
                                      help='File to store distribution in (CSV).')
 
+    # update command
+    parser_update = command_parsers.add_parser('update', help=cmd_help(commands.update))
+    parser_update.set_defaults(command=commands.update, lsh_only=True, in_memory=True, whole_buckets=True)
+    parser_update.add_argument('new_rows', metavar='rows',
+                               help='Path to the new ratings in .npy format.')
+    parser_update.add_argument('--results', default="results.txt",
+                               help='File to append new pairs of user IDs to.')
+
+    # knn-graph command
+    parser_knn = command_parsers.add_parser('knn-graph', help=cmd_help(commands.knn_graph))
+    parser_knn.set_defaults(command=commands.knn_graph, lsh_only=True)
+    parser_knn.add_argument('-k', type=int, default=10,
+                            help='Number of neighbours per user. Default: 10.')
+    parser_knn.add_argument('--results', default="knn_graph.npz",
+                            help='File to store the graph in (.npz).')
+
+    # band-sharded commands
+    shard_args = argparse.ArgumentParser(add_help=False)
+    shard_args.add_argument('--dir', default="shards",
+                            help='Directory shared by all map and reduce tasks. Default: shards.')
+    shard_args.add_argument('--shards', type=int, default=4,
+                            help='Number of map tasks, each owning a range of bands. Default: 4.')
+    shard_args.add_argument('--partitions', type=int, default=4,
+                            help='Number of reduce tasks. Default: 4.')
+
+    parser_sharded = command_parsers.add_parser('sharded', parents=[shard_args],
+                                                help=cmd_help(commands.sharded))
+    parser_sharded.set_defaults(command=commands.sharded, prepare='matrices',
+                                lsh_only=True, in_memory=True)
+    parser_sharded.add_argument('--results', default="results.txt",
+                                help='File to store pairs of user IDs in.')
+
+    parser_shard_map = command_parsers.add_parser('shard-map', parents=[shard_args],
+                                                  help=cmd_help(commands.shard_map))
+    parser_shard_map.set_defaults(command=commands.shard_map, prepare='matrices',
+                                  lsh_only=True, in_memory=True)
+    parser_shard_map.add_argument('shard', type=int, help='Index of the shard to map.')
+
+    parser_shard_reduce = command_parsers.add_parser('shard-reduce', parents=[shard_args],
+                                                     help=cmd_help(commands.shard_reduce))
+    parser_shard_reduce.set_defaults(command=commands.shard_reduce, prepare='matrices',
+                                     lsh_only=True)
+    parser_shard_reduce.add_argument('partition', type=int, help='Index of the partition to reduce.')
+
+    # serve command
+    parser_serve = command_parsers.add_parser('serve', help=cmd_help(commands.serve))
+    parser_serve.set_defaults(command=commands.serve, lsh_only=True, in_memory=True)
+    parser_serve.add_argument('--host', default="127.0.0.1",
+                              help='Address to listen on. Default: 127.0.0.1.')
+    parser_serve.add_argument('--port', type=int, default=7733,
+                              help='Port to listen on. Default: 7733.')
+
     # console command
     parser_console = command_parsers.add_parser('console',
                                                 help=cmd_help(commands.console))
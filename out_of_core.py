@@ -0,0 +1,311 @@
+import numpy as np
+from scipy import sparse
+import gc
+import os
+import time
+
+from data import to_csr
+import signatures
+from buckets import BucketTable, signature_keys, pack_pairs, unpack_pairs, mix
+from pair_finder import PairFinder, MINHASH_PRIME
+from util import ensure_directory
+
+
+"""Out-of-core pair finder for ratings that don't fit in memory.
+
+All arrays that grow with the number of ratings or pairs live in files
+of a spill directory, and are processed in blocks sized by a memory
+limit:
+
+1. The document-major matrix is built with a counting sort straight
+   into memory-mapped files. Verification reads the rows of the pairs
+   back through the mapping.
+2. Signatures are computed for one block of users at a time and written
+   to a memory-mapped signature matrix. The bucket keys of the block
+   are spilled right away as (key, user) records, one file per band and
+   key partition.
+3. Every key file is small enough to be sorted in memory. Its buckets
+   give the candidate pairs, which are spilled as packed uint64 keys to
+   files partitioned by a hash of the pair.
+4. Every pair file is deduplicated with a sort, after splitting it again
+   if it is too large. This removes the pairs found in several bands.
+
+Only arrays with one entry per user (indptr, set sizes) are kept in
+memory, along with the hash functions.
+
+Layout of the spill directory:
+    data.npy, indices.npy     document-major matrix
+    signatures.npy            signature matrix
+    band-<b>-<p>.bin          (key, user) records of band b, partition p
+    pairs-<q>.bin[-<r>...]    distinct packed pairs
+"""
+
+
+_RECORD = np.dtype([('key', np.uint64), ('doc', np.int32)])
+
+
+class OutOfCorePairFinder(PairFinder):
+    """PairFinder that keeps its data in files and caps its memory use.
+
+    Candidates, counts and verification work like in PairFinder, but
+    there is no bucket table (buckets) in memory, so methods using it
+    (progressive_candidates(), query_candidates(), update(),
+    save_index() and prepare_bands()) don't work. Neither do bit-packed
+    matrices, b-bit signatures and bucket splitting. Signatures are
+    computed in this process, whatever jobs is.
+
+    Args:
+        directory (string): Directory for the spilled files.
+        memory_limit (int): Approximate cap in bytes on the memory used
+            for blocks of ratings, users and pairs, and for the queue
+            of prioritized_candidates().
+        All other arguments are those of PairFinder.
+    """
+
+    def __init__(self, data, *args, directory = "spill", memory_limit = 2**30, **kwargs):
+        super().__init__(data, *args, **kwargs)
+        self.sparse_ds = True
+        self.directory = directory
+        self.memory_limit = memory_limit
+        ensure_directory(directory)
+
+    def candidate_batches(self, threshold = 0.0, batch_size = 2**16):
+        """Yields all candidate pairs in batches of numpy arrays, read from the pair files.
+
+        Like PairFinder.candidate_batches(), but the pairs come in the
+        order of the pair files, which is random.
+        """
+        for f in self.pair_files:
+            if os.path.getsize(f) == 0:
+                continue
+            c1, c2 = unpack_pairs(np.fromfile(f, dtype=np.uint64))
+            yield from self._score_batches(c1, c2, threshold, batch_size)
+
+    def prioritized_candidates(self, threshold = 0.0, eager_threshold = 0.75,
+                               max_queued = None, batch_size = 2**16):
+        """Like PairFinder.prioritized_candidates(), with max_queued derived from memory_limit.
+
+        Queued pairs take 8 bytes each, and about as much again while
+        they are drained.
+        """
+        if max_queued is None:
+            max_queued = max(self.memory_limit // 16, 1)
+        return super().prioritized_candidates(threshold, eager_threshold, max_queued, batch_size)
+
+    def count_candidates(self):
+        """Returns the number of distinct candidate pairs."""
+        return self.n_candidates
+
+    def count_buckets(self):
+        """Returns the number of non-empty buckets in all bands."""
+        return self.n_used
+
+    def print_stats(self):
+        """Prints useful stats for model diagnostics."""
+        print("Used {} buckets, {} with more than one document".format(self.n_used, self.n_shared))
+        print("{} distinct candidate pairs of {} in all buckets".format(
+            self.n_candidates, self.n_bucket_pairs))
+
+
+
+    ##### Private methods
+
+    def _compute_document_shingle_matrix(self):
+        # DU is built directly, into memory-mapped files, and DS is its
+        # transpose, which is a view.
+        print("Computing document-shingle matrix in {}...".format(self.directory))
+        t = time.time()
+        n = len(self.docs)
+        shape = (self.n_docs + 1, self.n_shingles + 1)
+
+        indices = self._spill_array("indices.npy", np.int32, n)
+        indptr, indices = to_csr(self.docs, self.shingles, shape[0], self.first_id,
+                                 chunk_size=max(self.memory_limit // 64, 1), indices=indices)
+        ones = self._spill_array("data.npy", np.uint8, n)
+        ones[:] = 1
+        self.DU = sparse.csr_matrix((ones, indices, indptr), shape=shape)
+        self.DS = self.DU.T
+
+        del self.shingles
+        del self.docs
+        gc.collect()
+
+        print("Done in {}s".format(time.time() - t))
+
+    def _compute_document_index(self):
+        """Sorts the shingles of every document in place and computes the set sizes."""
+        indptr, indices = self.DU.indptr, self.DU.indices
+        for first, last in self._user_blocks():
+            lo, hi = indptr[first], indptr[last]
+            rows = np.repeat(np.arange(last - first), np.diff(indptr[first:last + 1]))
+            block = np.array(indices[lo:hi])
+            indices[lo:hi] = block[np.lexsort((block, rows))]
+        self.DU.has_sorted_indices = True
+        self.doc_sizes = np.diff(indptr)
+
+    def _compute_signatures(self, rows = None):
+        # Signatures of a block of users are computed, stored and spilled
+        # as bucket keys before the next block is read. They are always
+        # computed for all rows, rows is only there for prepare_bands().
+        print("Computing signatures using {} in blocks of users...".format(self.signature_method))
+        t = time.time()
+
+        if self.signature_method == 'minhash':
+            table, fill = self._minhash_table(slice(0, self.sig_len)), MINHASH_PRIME
+        elif self.signature_method == 'permutation':
+            table = self._permutation_table(slice(0, self.sig_len))
+            fill = table.shape[1]
+        elif self.signature_method == 'oph':
+            ranks = self._one_permutation_ranks()
+        else:
+            raise ValueError("'{}' is not a signature method.".format(self.signature_method))
+
+        # about 48 bytes per record are needed to sort a key file
+        self.n_key_parts = max(-(-self.n_docs * 48 // self.memory_limit), 1)
+        key_files = [[self._spill_file("band-{}-{}.bin".format(b, p))
+                      for p in range(self.n_key_parts)] for b in range(self.n_bands)]
+
+        indptr, indices = self._document_index()
+        blocks = self._user_blocks()
+        for k, (first, last) in enumerate(blocks):
+            lo, hi = indptr[first], indptr[last]
+            block_indptr = indptr[first:last + 1] - lo
+            block_indices = np.asarray(indices[lo:hi])
+
+            if self.signature_method == 'oph':
+                S = signatures.one_permutation(ranks, block_indptr, block_indices, self.sig_len)
+            else:
+                S = np.full((self.sig_len, last - first), fill, dtype=table.dtype)
+                for start in range(0, self.sig_len, self.signature_block):
+                    stop = min(start + self.signature_block, self.sig_len)
+                    signatures.segment_min(table[start:stop, :][:, block_indices],
+                                           block_indptr, S[start:stop, :])
+
+            if first == 0:
+                self.S = np.lib.format.open_memmap(
+                    os.path.join(self.directory, "signatures.npy"), mode='w+',
+                    dtype=S.dtype, shape=(self.sig_len, self.n_docs))
+            self.S[:, first:last] = S
+
+            docs = np.arange(first, last, dtype=np.int32)
+            for b, keys in enumerate(signature_keys(S, self.n_bands)):
+                records = np.empty(len(keys), dtype=_RECORD)
+                records['key'], records['doc'] = keys, docs
+                _append_partitioned(records, keys % np.uint64(self.n_key_parts), key_files[b])
+            print("  {}/{} blocks done in {}s".format(k + 1, len(blocks), time.time() - t), end = '\r')
+        print("")
+        self.S.flush()
+
+        print("Done in {}s".format(time.time() - t))
+
+    def _fill_buckets(self):
+        # Buckets of every key file are formed in memory, their pairs are
+        # spilled and finally deduplicated file by file.
+        print("Filling buckets from {} key files...".format(self.n_bands * self.n_key_parts))
+        t = time.time()
+        self.n_used = self.n_shared = self.n_bucket_pairs = 0
+
+        # about 16 bytes per pair are spilled at once, the rest is for the buckets
+        spill_size = max(self.memory_limit // 64, 1)
+        n_pair_parts = 16
+        pair_files = [self._spill_file("pairs-{}.bin".format(q)) for q in range(n_pair_parts)]
+        buffered, n_buffered = [], 0
+        for b in range(self.n_bands):
+            for p in range(self.n_key_parts):
+                f = os.path.join(self.directory, "band-{}-{}.bin".format(b, p))
+                records = np.fromfile(f, dtype=_RECORD)
+                os.remove(f)
+                table = BucketTable(records['key'].reshape(1, -1))
+                self.n_used += table.n_used
+                self.n_shared += len(table.sizes())
+                self.n_bucket_pairs += table.count_candidates()
+
+                for i, j in table.pair_batches(spill_size):
+                    buffered.append(pack_pairs(records['doc'][i], records['doc'][j]))
+                    n_buffered += len(i)
+                    if n_buffered >= spill_size:
+                        pairs = np.concatenate(buffered)
+                        _append_partitioned(pairs, mix(pairs) % np.uint64(n_pair_parts), pair_files)
+                        buffered, n_buffered = [], 0
+            print("  {}/{} bands done in {}s".format(b + 1, self.n_bands, time.time() - t), end = '\r')
+        print("")
+        if buffered:
+            pairs = np.concatenate(buffered)
+            _append_partitioned(pairs, mix(pairs) % np.uint64(n_pair_parts), pair_files)
+        del buffered
+
+        print("Removing duplicate pairs...")
+        self.pair_files = [s for f in pair_files for s in self._sort_pairs(f)]
+        self.n_candidates = sum(os.path.getsize(f) // 8 for f in self.pair_files)
+
+        print("Done in {}s".format(time.time() - t))
+
+    def _sort_pairs(self, filename, depth = 0):
+        """Replaces a pair file by its distinct pairs, sorted.
+
+        Files too large to sort in memory (about 32 bytes per pair) are
+        split by another hash of the pairs first, up to depth 3.
+
+        Returns:
+            list: The files holding the distinct pairs.
+        """
+        n = os.path.getsize(filename) // 8
+        n_parts = -(-n * 32 // self.memory_limit)
+        if n_parts <= 1 or depth >= 3:
+            np.unique(np.fromfile(filename, dtype=np.uint64)).tofile(filename)
+            return [filename]
+
+        parts = [self._spill_file("{}-{}".format(os.path.basename(filename), r))
+                 for r in range(n_parts)]
+        pairs = np.memmap(filename, dtype=np.uint64, mode='r')
+        chunk = max(self.memory_limit // 32, 1)
+        for start in range(0, n, chunk):
+            block = np.array(pairs[start:start + chunk])
+            _append_partitioned(block, mix(block + np.uint64(depth + 1)) % np.uint64(n_parts), parts)
+        del pairs
+        os.remove(filename)
+        return [s for f in parts for s in self._sort_pairs(f, depth + 1)]
+
+    def _user_blocks(self):
+        """Returns (first, last) ranges of users whose blocks fit the memory limit.
+
+        A block needs about 16 + 8 * signature_block bytes per rating
+        (48 for one-permutation hashing) and 8 * sig_len + 24 * bands
+        bytes per user.
+        """
+        per_rating = 48 if self.signature_method == 'oph' else 16 + 8 * self.signature_block
+        per_user = 8 * self.sig_len + 24 * self.n_bands
+        indptr = self.DU.indptr[:self.n_docs + 1].astype(np.int64)
+        cost = indptr * per_rating + np.arange(len(indptr)) * per_user
+
+        blocks = []
+        first = 0
+        while first < self.n_docs:
+            last = int(np.searchsorted(cost, cost[first] + self.memory_limit, side='right')) - 1
+            last = min(max(last, first + 1), self.n_docs)
+            blocks.append((first, last))
+            first = last
+        return blocks
+
+    def _spill_file(self, name):
+        """Creates an empty file in the spill directory and returns its path."""
+        filename = os.path.join(self.directory, name)
+        open(filename, "wb").close()
+        return filename
+
+    def _spill_array(self, name, dtype, n):
+        return np.lib.format.open_memmap(os.path.join(self.directory, name), mode='w+',
+                                         dtype=dtype, shape=(n,))
+
+
+
+
+def _append_partitioned(values, part, files):
+    """Appends the values to the file of their partition."""
+    order = np.argsort(part, kind='mergesort')
+    values, part = values[order], part[order]
+    bounds = np.searchsorted(part, np.arange(len(files) + 1, dtype=np.uint64))
+    for p, f in enumerate(files):
+        if bounds[p] < bounds[p + 1]:
+            with open(f, "ab") as out:
+                values[bounds[p]:bounds[p + 1]].tofile(out)
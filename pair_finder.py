@@ -1,59 +1,120 @@
 import numpy as np
 from scipy import sparse
-from collections import defaultdict
 import time
-import pickle
 import gc
 
-from util import ensure_directory
+from data import to_csr
+import signatures
+import parallel
+import bits
+import index_file
+from buckets import BucketTable, band_keys, signature_keys
+from priority import LevelQueue
+import cache
+from cache import ArtifactCache
 
 
 """Pair-finder algorithm using min-hashing and location sensitive hashing.
 
 Args:
-    data (pandas.DataFrame): Data frame with two columns (document_ids,
-        shingle_ids).
+    data (numpy.ndarray): Array with two columns (document IDs, shingle
+        IDs), e.g. memory-mapped by data.load(). It is never copied.
     sig_len (int): Number of hashes per signature.
     bands (int): Number of signature segments.
-    max_buckets (int): Maximum number of buckets. Should be high enough
-        to prevent collisions.
     signature_method (string): Method of generating signatures. Can be
-        'minhash' or 'permutation'.
+        'minhash', 'permutation' or 'oph' (densified one-permutation
+        hashing, a single pass for the whole signature at a small loss
+        of accuracy).
     use_sparse (bool): Whether to use a sparse or dense document-shingle
         matrix. Dense consumes more memory, but makes computing Jaccard-
         similarities many orders of magnitude faster.
+    use_bits (bool): Whether to verify pairs on a bit-packed copy of the
+        document-shingle matrix (one row of uint64 words per document)
+        with popcounts. Uses 8 times less memory than the dense matrix
+        and is the fastest way to verify batches. Implies use_sparse.
+    bbits (int, optional): Compare signatures using only the lowest
+        bbits bits of every value (b-bit minwise hashing), packed into
+        uint64 words. Makes scoring candidates much faster at a small
+        loss of accuracy. Must divide 64.
+    max_bucket_size (int, optional): Split buckets with more members
+        by re-hashing them on extra signature rows (see
+        BucketTable.split). Default: don't split.
+    signature_block (int): Number of hash functions to compute at once.
+        Bounds the memory used for signature computation to about
+        signature_block * (number of ratings) hash values.
+    jobs (int): Number of processes computing signatures (see
+        parallel.py). Memory use grows with jobs * signature_block.
+        The signatures don't depend on it.
+    first_id (int): ID of the first document and shingle in data.
 
     sig_len must be divisible by bands.
 """
 
 
+MINHASH_PRIME = 17783 # prime number > number of shingles
+
+
 class PairFinder:
     """MinHash/LSH algorithm to find pairs of similar documents."""
 
-    def __init__(self, data, sig_len, bands, max_buckets,
-                 signature_method='minhash', use_sparse=False):
+    def __init__(self, data, sig_len, bands,
+                 signature_method='minhash', use_sparse=False, use_bits=False,
+                 bbits=None, max_bucket_size=None, signature_block=4, jobs=1, first_id=1):
+        self.set_params(sig_len, bands)
+        self._set_data(data, first_id)
+        self.signature_method = signature_method
+        self.sparse_ds = use_sparse or use_bits
+        self.bits_ds = use_bits
+        self.bbits = bbits
+        self.max_bucket_size = max_bucket_size
+        self.signature_block = signature_block
+        self.jobs = jobs
+
+    def set_params(self, sig_len, bands):
+        """Sets signature length and number of bands, before prepare()."""
         if sig_len % bands != 0:
             raise Exception("sig_len ({}) must be divisible by bands ({})".format(sig_len, bands))
 
-        self.docs = data.iloc[:, 0]
-        self.shingles = data.iloc[:, 1]
-        self.n_docs = np.max(self.docs) + 1
-        self.n_shingles = np.max(self.shingles) + 1
         self.sig_len = sig_len
         self.n_bands = bands
-        self.max_buckets = max_buckets
-        self.signature_method = signature_method
-        self.sparse_ds = use_sparse
-
-        if self.signature_method == 'permutation' and not self.sparse_ds:
-            raise RuntimeError("Permutation is only supported with a sparse matrix.")
 
     def prepare(self):
         """Initialize everything that's required."""
-        self._compute_document_shingle_matrix()
+        self.prepare_matrices()
         self._compute_signatures()
+        self._pack_signatures()
         self._fill_buckets()
 
+    def prepare_bands(self, first, last):
+        """Initializes signatures and buckets of only the bands first to last - 1.
+
+        This is for sharding the bands across processes (see
+        sharded.py): S only holds the rows of these bands and buckets
+        number them from 0. The hash functions are the same as in
+        prepare().
+        """
+        self.prepare_matrices()
+        band_len = self.sig_len // self.n_bands
+        self._compute_signatures(slice(first * band_len, last * band_len))
+
+        print("Filling buckets of bands {} to {}...".format(first, last - 1))
+        t = time.time()
+        self.buckets = BucketTable.from_signatures(self.S, last - first)
+        if self.max_bucket_size:
+            self.buckets.split(self.max_bucket_size, self._extra_signatures)
+        print("Done in {}s".format(time.time() - t))
+
+    def prepare_matrices(self):
+        """Computes the document-shingle matrices, unless already done.
+
+        This is the part of prepare() that doesn't depend on sig_len and
+        bands, so it can be used before choosing them.
+        """
+        if hasattr(self, 'DU'):
+            return
+        self._compute_document_shingle_matrix()
+        self._compute_document_index()
+
     def candidates(self, threshold = 0.0):
         """Yields all candidate pairs and the similarity of their signatures.
 
@@ -66,19 +127,144 @@ class PairFinder:
         Yields:
             tuple: ((c1, c2), similarity)
         """
-        done = set()
-
-        for b in self.buckets.values():
-            b = list(b)
-            for i in range(len(b)):
-                for j in range(i + 1, len(b)):
-                    c1, c2 = min(b[i], b[j]), max(b[i], b[j])
-                    c = (c1, c2)
-                    if c not in done:
-                        done.add(c)
-                        sim = self.sig_sim(c1, c2)
-                        if sim >= threshold:
-                            yield ((c1, c2), sim)
+        for c1, c2, sim in self.candidate_batches(threshold):
+            for c in zip(c1.tolist(), c2.tolist(), sim.tolist()):
+                yield ((c[0], c[1]), c[2])
+
+    def candidate_batches(self, threshold = 0.0, batch_size = 2**16):
+        """Yields all candidate pairs in batches of numpy arrays.
+
+        Like candidates(), but pairs are generated, deduplicated and
+        scored a whole batch at a time, and at most batch_size pairs
+        are held in memory at once.
+
+        Args:
+            threshold (float): Require this similarity for a candidate to be yielded.
+            batch_size (int): Maximum number of pairs per batch.
+
+        Yields:
+            tuple: (c1, c2, similarity) arrays, with c1 < c2.
+        """
+        for c1, c2 in self.buckets.pair_batches(batch_size):
+            sim = self.sig_sim(c1, c2)
+            keep = sim >= threshold
+            yield c1[keep], c2[keep], sim[keep]
+
+    def prioritized_candidates(self, threshold = 0.0, eager_threshold = 0.75,
+                               max_queued = 2**26, batch_size = 2**16):
+        """Streams candidate batches, roughly highest signature similarity first.
+
+        Candidates with a signature similarity of at least
+        eager_threshold are yielded as soon as their batch is generated,
+        so the most promising pairs are available right after prepare().
+        All others are kept in a queue with one level per possible
+        signature similarity and yielded highest level first once all
+        candidates have been generated.
+
+        Args:
+            threshold (float): Require this similarity for a candidate to be yielded.
+            eager_threshold (float): Yield candidates with at least this
+                similarity without waiting for the rest.
+            max_queued (int): Maximum number of candidates waiting in the
+                queue. The lowest levels are dropped when exceeded.
+            batch_size (int): Maximum number of pairs per batch.
+
+        Yields:
+            tuple: (c1, c2, similarity) arrays, with c1 < c2, and every
+                batch sorted by decreasing similarity.
+        """
+        queue = LevelQueue(self.sig_len + 1, max_queued)
+
+        for c1, c2, sim in self.candidate_batches(threshold, batch_size):
+            eager = sim >= eager_threshold
+            if np.any(eager):
+                order = np.argsort(-sim[eager], kind='mergesort')
+                yield c1[eager][order], c2[eager][order], sim[eager][order]
+
+            level = np.rint(sim[~eager] * self.sig_len).astype(np.int64)
+            queue.push(c1[~eager], c2[~eager], level)
+
+        print("Queued {} candidates, dropped {}".format(len(queue), queue.dropped))
+        for c1, c2 in queue.drain(batch_size):
+            yield c1, c2, self.sig_sim(c1, c2)
+
+    def progressive_candidates(self, threshold = 0.0, max_queued = 2**26, batch_size = 2**16):
+        """Prepares signatures and buckets band by band, streaming candidates meanwhile.
+
+        Use instead of prepare(), so that pairs can be found from the
+        start: the candidates of a band are yielded, highest signature
+        similarity first, before the signatures of the next band are
+        computed. A pair is only yielded for the lowest band in which
+        it collides. Similarities are estimated from the signature rows
+        computed so far. One-permutation signatures are computed for
+        all bands at once, as densification needs all bins.
+
+        The hash functions are the same as in prepare(), and once all
+        bands are done, so is the state.
+
+        Args:
+            threshold (float): Require this similarity for a candidate to be yielded.
+            max_queued (int): Maximum number of candidates of a band
+                waiting to be yielded. The least similar are dropped.
+            batch_size (int): Maximum number of pairs per batch.
+
+        Yields:
+            tuple: (c1, c2, similarity, rows) with c1 < c2, where rows is
+                the number of signature rows the similarities are
+                estimated from.
+        """
+        if self.max_bucket_size:
+            raise NotImplementedError("progressive_candidates() doesn't support split buckets")
+
+        self.prepare_matrices()
+        table = None
+        if self.signature_method == 'oph':
+            self._compute_signatures()
+        elif self.signature_method == 'minhash':
+            table = self._minhash_table(slice(0, self.sig_len))
+            self.S = np.full((self.sig_len, self.n_docs), MINHASH_PRIME, dtype=table.dtype)
+        elif self.signature_method == 'permutation':
+            table = self._permutation_table(slice(0, self.sig_len))
+            self.S = np.full((self.sig_len, self.n_docs), table.shape[1], dtype=table.dtype)
+        else:
+            raise ValueError("'{}' is not a signature method.".format(self.signature_method))
+
+        # the workers are started once, not for every band
+        workers = None
+        if table is not None:
+            indptr, indices = self._document_index()
+            workers = parallel.SignatureWorkers(table, indptr, indices, self.S, self.jobs,
+                                                block=self.signature_block)
+
+        band_len = self.sig_len // self.n_bands
+        keys = np.empty((self.n_bands, self.n_docs), dtype=np.uint64)
+        try:
+            for b in range(self.n_bands):
+                t = time.time()
+                rows = slice(b * band_len, (b + 1) * band_len)
+                if workers is not None:
+                    workers.compute(rows.start, rows.stop)
+                keys[b] = band_keys(self.S[rows])
+
+                queue = LevelQueue(rows.stop + 1, max_queued)
+                for c1, c2 in BucketTable(keys[b:b + 1]).pair_batches(batch_size):
+                    new = ~np.any(keys[:b, c1] == keys[:b, c2], axis=0)
+                    c1, c2 = c1[new], c2[new]
+                    level = np.sum(self.S[:rows.stop, c1] == self.S[:rows.stop, c2], axis=0)
+                    keep = level >= threshold * rows.stop
+                    queue.push(c1[keep], c2[keep], level[keep])
+                print("Band {}/{}: {} new candidates after {}s".format(
+                    b + 1, self.n_bands, len(queue), time.time() - t))
+
+                for c1, c2 in queue.drain(batch_size):
+                    sim = np.mean(self.S[:rows.stop, c1] == self.S[:rows.stop, c2], axis=0)
+                    yield c1, c2, sim, rows.stop
+        finally:
+            if workers is not None:
+                workers.close()
+
+        self._pack_signatures()
+        self.buckets = BucketTable(keys)
 
     def count_candidates(self):
         """Returns the number of candidate pairs without iterating over all of them.
@@ -86,14 +272,38 @@ class PairFinder:
         This is an estimate an can overestimate the true value quite a
         bit, due to duplicates.
         """
-        return int(np.sum([
-            n * (n - 1) / 2
-            for n in [len(b) for b in self.buckets.values()]
-        ]))
+        return self.buckets.count_candidates()
+
+    def count_buckets(self):
+        """Returns the number of non-empty buckets in all bands."""
+        return len(self.buckets)
 
     def sig_sim(self, i, j):
-        """Returns the similarity of signatures for documents i and j."""
-        return np.mean(self.S[:, i] == self.S[:, j])
+        """Returns the similarity of signatures for documents i and j.
+
+        i and j can also be arrays of document IDs, in which case an
+        array of similarities is returned.
+
+        With b-bit signatures, this is the estimate corrected for
+        accidental agreement of the lowest bits.
+        """
+        if self.bbits:
+            return bits.bbit_similarity(self.SB, i, j, self.bbits, self.sig_len)
+        return np.mean(self.S[:, i] == self.S[:, j], axis=0)
+
+    def query_candidates(self, doc):
+        """Returns the candidates of a single document, highest signature similarity first.
+
+        The candidates are all documents sharing a bucket with doc in
+        any band.
+
+        Returns:
+            tuple: (docs, signature similarities) arrays.
+        """
+        others = self.buckets.neighbours(doc)
+        sim = self.sig_sim(np.full(len(others), doc), others)
+        order = np.argsort(-sim, kind='mergesort')
+        return others[order], sim[order]
 
     def jaccard_similarity(self, i, j):
         """Returns the Jaccard similarity of documents i and j from the document-shingle matrix."""
@@ -106,25 +316,180 @@ class PairFinder:
         return np.logical_and(d1, d2).sum() / np.logical_or(d1, d2).sum()
 
 
+    def verify_batch(self, c1, c2):
+        """Returns the Jaccard similarities of many pairs of documents at once.
+
+        Intersections are computed with a row-wise product of the
+        document-major matrix (or popcounts of the bit-packed matrix),
+        and unions from the precomputed set sizes as |A| + |B| - |A & B|.
+
+        Args:
+            c1 (numpy.ndarray): Document IDs of the first documents.
+            c2 (numpy.ndarray): Document IDs of the second documents.
+
+        Returns:
+            numpy.ndarray: Jaccard similarity of c1[k] and c2[k] for every k.
+        """
+        if self.bits_ds:
+            inter = bits.intersection_sizes(self.DB, c1, c2)
+        else:
+            inter = np.diff(self.DU[c1].multiply(self.DU[c2]).tocsr().indptr)
+        union = self.doc_sizes[c1] + self.doc_sizes[c2] - inter
+        return inter / np.maximum(union, 1)
+
+    def update(self, new_rows, threshold = 0.0, batch_size = 2**16):
+        """Adds ratings, and possibly new documents, to the prepared state.
+
+        Only the signatures of documents with new rows are updated: with
+        min-hashing and permutations, the new signature is the
+        elementwise minimum of the old one and the hashes of the new
+        shingles. One-permutation signatures are recomputed for these
+        documents, as densification can't be merged. Only the updated
+        documents change buckets. New shingles need min-hashing, and
+        split buckets (max_bucket_size) are not supported.
+
+        The update happens right away, the new candidates are generated
+        when iterating over the result.
+
+        Args:
+            new_rows (numpy.ndarray): Array with two columns (document
+                IDs, shingle IDs), IDs starting at first_id like data.
+            threshold (float): Require this similarity for a candidate to be yielded.
+            batch_size (int): Maximum number of pairs per batch.
+
+        Returns:
+            generator: (c1, c2, similarity) arrays of only the pairs that
+                became candidates, with c1 < c2.
+        """
+        print("Updating with {} new rows...".format(len(new_rows)))
+        t = time.time()
+
+        docs = np.asarray(new_rows[:, 0], dtype=np.int64) - self.first_id
+        shingles = np.asarray(new_rows[:, 1], dtype=np.int64) - self.first_id
+        n_docs = max(self.n_docs, int(np.max(docs)) + 1)
+        n_shingles = max(self.n_shingles, int(np.max(shingles)) + 1)
+        if n_shingles > self.n_shingles and self.signature_method != 'minhash':
+            raise NotImplementedError("New shingles are only supported with minhash signatures")
+
+        # documents with new rows and all new documents
+        affected = np.union1d(docs, np.arange(self.n_docs, n_docs))
+
+        delta = self._extend_matrices(docs, shingles, n_docs, n_shingles)
+        self.n_docs, self.n_shingles = n_docs, n_shingles
+        self._update_signatures(affected, delta)
+        c1, c2 = self.buckets.update(
+            affected, signature_keys(self.S[:, affected], self.n_bands))
+
+        print("{} new candidate pairs".format(len(c1)))
+        print("Done in {}s".format(time.time() - t))
+        return self._score_batches(c1, c2, threshold, batch_size)
+
+    def save_index(self, filename):
+        """Stores the prepared state in a single index file (see index_file.py).
+
+        The file holds the document-major matrix, the set sizes, the
+        signatures, their hash functions and the buckets, which is
+        everything needed to find and verify candidates and to update().
+        Open it with PairFinder.load_index().
+        """
+        print("Saving index to {}...".format(filename))
+        t = time.time()
+
+        arrays = {'DU_data': self.DU.data, 'DU_indices': self.DU.indices,
+                  'DU_indptr': self.DU.indptr, 'doc_sizes': self.doc_sizes, 'S': self.S}
+        if self.bits_ds:
+            arrays['DB'] = self.DB
+        if self.bbits:
+            arrays['SB'] = self.SB
+        arrays.update(_prefixed(self.buckets.to_arrays(), 'buckets_'))
+        arrays.update(_prefixed(self.hash_params, 'hash_'))
+
+        meta = {'sig_len': self.sig_len, 'bands': self.n_bands,
+                'signature_method': self.signature_method, 'use_bits': self.bits_ds,
+                'bbits': self.bbits, 'max_bucket_size': self.max_bucket_size,
+                'first_id': self.first_id, 'n_docs': self.n_docs,
+                'n_shingles': self.n_shingles, 'DU_shape': list(self.DU.shape)}
+        index_file.save(filename, arrays, meta)
+
+        print("Done in {}s".format(time.time() - t))
+
+    @classmethod
+    def load_index(cls, filename):
+        """Opens an index file written by save_index().
+
+        All arrays are memory-mapped, so opening is nearly instant and
+        the pages are shared by concurrent processes. The returned
+        PairFinder is prepared, but has no data to prepare it again.
+        """
+        arrays, meta = index_file.load(filename)
+
+        pf = cls.__new__(cls)
+        pf.set_params(meta['sig_len'], meta['bands'])
+        pf.signature_method = meta['signature_method']
+        pf.sparse_ds = True
+        pf.bits_ds = meta['use_bits']
+        pf.bbits = meta['bbits']
+        pf.max_bucket_size = meta['max_bucket_size']
+        pf.first_id = meta['first_id']
+        pf.n_docs = meta['n_docs']
+        pf.n_shingles = meta['n_shingles']
+        pf.signature_block = 4
+        pf.jobs = 1
+
+        pf.DU = sparse.csr_matrix(
+            (arrays['DU_data'], arrays['DU_indices'], arrays['DU_indptr']),
+            shape=tuple(meta['DU_shape']), copy=False)
+        pf.DU.has_sorted_indices = True
+        pf.DS = pf.DU.T
+        pf.doc_sizes = arrays['doc_sizes']
+        pf.S = arrays['S']
+        if pf.bits_ds:
+            pf.DB = arrays['DB']
+        if pf.bbits:
+            pf.SB = arrays['SB']
+        pf.buckets = BucketTable.from_arrays(_unprefixed(arrays, 'buckets_'))
+        pf.hash_params = _unprefixed(arrays, 'hash_')
+        return pf
+
     def print_stats(self):
         """Prints useful stats for model diagnostics."""
-        print("Used {}/{} buckets".format(len(self.buckets), self.max_buckets))
+        print("Used {} buckets, {} with more than one document".format(
+            len(self.buckets), len(self.buckets.sizes())))
         print("Up to {} candidate pairs".format(self.count_candidates()))
+        if self.buckets.avoided:
+            print("Splitting oversized buckets avoided {} candidate pairs".format(self.buckets.avoided))
 
 
 
     ##### Private methods
 
+    def _set_data(self, data, first_id):
+        """Keeps views of the document and shingle columns of data.
+
+        IDs are shifted to start at 0 only when the matrices are built.
+        """
+        self.docs = data[:, 0]
+        self.shingles = data[:, 1]
+        self.first_id = first_id
+        self.n_docs = int(np.max(self.docs)) - first_id + 1
+        self.n_shingles = int(np.max(self.shingles)) - first_id + 1
+
     def _compute_document_shingle_matrix(self):
-        # CSC -> 16s for creation, .988s per random row permutation
-        # CSR -> 37s for creation, .537s per random row permutation
+        # The sparse matrix is built directly from its CSR structure with
+        # a counting sort, the dense one chunk by chunk.
         print("Computing document-shingle matrix...")
         t = time.time()
+        shape = (self.n_shingles + 1, self.n_docs + 1)
         if self.sparse_ds:
-            self.DS = sparse.csr_matrix((self.n_shingles + 1, self.n_docs + 1), dtype=np.uint8)
+            indptr, indices = to_csr(self.shingles, self.docs, shape[0], self.first_id)
+            ones = np.ones(len(indices), dtype=np.uint8)
+            self.DS = sparse.csr_matrix((ones, indices, indptr), shape=shape)
         else:
-            self.DS = np.zeros((self.n_shingles + 1, self.n_docs + 1), dtype=np.uint8)
-        self.DS[self.shingles, self.docs] = 1
+            self.DS = np.zeros(shape, dtype=np.uint8)
+            chunk = 2**24
+            for start in range(0, len(self.docs), chunk):
+                self.DS[self.shingles[start:start + chunk] - self.first_id,
+                        self.docs[start:start + chunk] - self.first_id] = 1
 
         del self.shingles
         del self.docs
@@ -132,87 +497,220 @@ class PairFinder:
 
         print("Done in {}s".format(time.time() - t))
 
-    def _compute_signatures(self):
+    def _compute_signatures(self, rows = None):
         # 12.7523s * siglen
+        # rows (slice) selects the signature rows to compute, all by default.
+        # The same random numbers are drawn either way.
         print("Computing signatures using {}...".format(self.signature_method))
         t = time.time()
+        rows = rows or slice(0, self.sig_len)
 
         if self.signature_method == 'minhash':
-            self._compute_signatures_minhash()
+            self._compute_signatures_minhash(rows)
         elif self.signature_method == 'permutation':
-            self._compute_signatures_permutation()
+            self._compute_signatures_permutation(rows)
+        elif self.signature_method == 'oph':
+            self._compute_signatures_oph(rows)
         else:
             raise ValueError("'{}' is not a signature method.".format(self.signature_method))
 
         print("Done in {}s".format(time.time() - t))
 
-    def _compute_signatures_minhash(self):
+    def _compute_signatures_minhash(self, rows):
         """Creates document signatures using min-hashing."""
+        table = self._minhash_table(rows)
+        self.S = np.full((len(table), self.n_docs), MINHASH_PRIME, dtype=table.dtype)
+        self._min_signatures(table)
+
+    def _minhash_table(self, rows):
+        """Draws the min-hash functions and returns the hash values of all shingles for rows."""
         # Generate sig_len hashfunctions (hash(x) = (a*x + b) % prime)
-        prime = 17783 # prime number > number of shingles
+        prime = MINHASH_PRIME
         a = np.random.choice(self.n_shingles, size=self.sig_len, replace=False)
         b = np.random.choice(self.n_shingles, size=self.sig_len, replace=False)
         b.shape = (self.sig_len, 1)
+        a, b = a[rows], b[rows]
+        self.hash_params = {'a': a, 'b': b}
+        return signatures.minhash_table(a, b, prime, self.DS.shape[0])
 
-        self.S = np.full((self.sig_len, self.n_docs), prime)
+    def _compute_signatures_permutation(self, rows):
+        """Creates document signatures using random row permutations.
 
-        if self.sparse_ds:
-            csr = self.DS
-        else:
-            csr = sparse.csr_matrix(self.DS, dtype=np.uint8)
+        Instead of permuting the rows of DS, every shingle gets a random
+        rank per signature row and each document takes the minimum rank
+        of its shingles, which is the first nonzero row after permuting.
+        """
+        table = self._permutation_table(rows)
 
-        for r in range(self.n_shingles): # row r
-            if r % 100 == 0:
-                print("{}% done".format(int(r / self.n_shingles * 100)), end = '\r')
+        # documents without shingles get a rank after all rows
+        self.S = np.full((len(table), self.n_docs), table.shape[1], dtype=table.dtype)
 
-            _, docs = np.nonzero(csr[r, :])
-            h = np.add(np.outer(a, r), b) % prime
-            self.S[:, docs] = np.minimum(self.S[:, docs], h)
+        self._min_signatures(table)
 
-        if not self.sparse_ds:
-            del csr
-            gc.collect()
+    def _permutation_table(self, rows):
+        """Draws the permutations and returns the rank of all shingles for rows."""
+        table = signatures.permutation_table(self.sig_len, self.DS.shape[0])[rows]
+        self.hash_params = {'table': table}
+        return table
 
-    def _compute_signatures_permutation(self):
-        """Creates document signatures using random row permutations.
+    def _compute_signatures_oph(self, rows):
+        """Creates document signatures using one-permutation hashing.
 
-        Not supported when using a dense document-shingle matrix.
+        One random permutation of the rows is split into sig_len bins,
+        and the signature holds the minimum per bin, with empty bins
+        densified from their neighbours. Densification needs all bins,
+        so they are always computed, and only the selected rows kept.
         """
-        self.S = np.zeros((self.sig_len, self.n_docs))
+        ranks = self._one_permutation_ranks()
+        indptr, indices = self._document_index()
+        if self.jobs > 1:
+            self.S = parallel.one_permutation(ranks, indptr, indices, self.sig_len, self.jobs)
+        else:
+            self.S = signatures.one_permutation(ranks, indptr, indices, self.sig_len)
+        if rows != slice(0, self.sig_len):
+            self.S = np.ascontiguousarray(self.S[rows])
+
+    def _one_permutation_ranks(self):
+        """Draws the permutation of one-permutation hashing and returns the rank of all shingles."""
+        ranks = np.random.permutation(self.DS.shape[0])
+        self.hash_params = {'ranks': ranks}
+        return ranks
+
+    def _min_signatures(self, table):
+        """Fills S with the minimum of table over the shingles of every document."""
+        indptr, indices = self._document_index()
+        if self.jobs > 1:
+            parallel.min_signatures(table, indptr, indices, self.S, self.jobs, block=self.signature_block)
+        else:
+            signatures.min_signatures(table, indptr, indices, self.S, block=self.signature_block)
 
-        for i in range(self.sig_len):
-            # Generate random permutation of rows
-            DSp = self.DS[np.random.permutation(self.DS.shape[0]), :]
+    def _pack_signatures(self):
+        """Packs the lowest bbits bits of every signature value into SB (b-bit mode only)."""
+        if self.bbits:
+            self.SB = bits.pack_low_bits(self.S, self.bbits)
 
-            # get indices of nonzero elements
-            nz_row, nz_col = DSp.nonzero()
+    def _compute_document_index(self):
+        """Creates the document-major CSR matrix DU and the set size of every document.
 
-            # get index of first nonzero index per column (user)
-            _, first_nz_i = np.unique(nz_col, return_index=True)
+        Rows of DU are documents and hold their sorted shingle IDs. When
+        using bits, DB holds the same rows packed into uint64 words.
+        """
+        if self.sparse_ds:
+            self.DU = self.DS.T.tocsr()
+        else:
+            self.DU = sparse.csr_matrix(self.DS.T, dtype=np.uint8)
+        self.DU.sort_indices()
+        self.doc_sizes = np.diff(self.DU.indptr)
 
-            # index of first non-zero row per column (next part of S)
-            self.S[i, :] = nz_row[first_nz_i]
+        if self.bits_ds:
+            self.DB = bits.pack_rows(self.DU)
 
-            print("  {}/{} done in {}s".format(i+1, self.sig_len, time.time() - t), end = '\r')
+    def _document_index(self):
+        """Returns indptr and indices of the document-major layout of DS.
 
+        Only the first n_docs documents are included, so the result lines
+        up with the columns of the signature matrix.
+        """
+        return self.DU.indptr[:self.n_docs + 1], self.DU.indices
 
-    def _fill_buckets(self):
-        print("Filling buckets...")
-        t = time.time()
+    def _extend_matrices(self, docs, shingles, n_docs, n_shingles):
+        """Adds rows to DU, DS and DB, growing them to n_docs and n_shingles.
 
-        band_len = int(self.sig_len / self.n_bands)
-        self.buckets = defaultdict(lambda: set())
+        Returns:
+            scipy.sparse.csr_matrix: The document-major matrix of only
+                the new rows.
+        """
+        shape = (n_docs + 1, n_shingles + 1)
+        delta = sparse.csr_matrix(
+            (np.ones(len(docs), dtype=np.uint8), (docs, shingles)), shape=shape)
+        delta.data[:] = 1
+
+        indptr = np.append(self.DU.indptr,
+                           np.full(shape[0] - self.DU.shape[0], self.DU.indptr[-1]))
+        self.DU = sparse.csr_matrix((self.DU.data, self.DU.indices, indptr), shape=shape) + delta
+        self.DU.data[:] = 1
+        self.DU.sort_indices()
+        self.doc_sizes = np.diff(self.DU.indptr)
 
-        for b in range(self.n_bands):
-            band_idx = slice(b*band_len, b*band_len + band_len)
+        if self.sparse_ds:
+            self.DS = self.DU.T
+        else:
+            DS = np.zeros(shape[::-1], dtype=np.uint8)
+            DS[:self.DS.shape[0], :self.DS.shape[1]] = self.DS
+            DS[shingles, docs] = 1
+            self.DS = DS
+
+        if self.bits_ds:
+            n_words = -(-shape[1] // 64)
+            if n_words != self.DB.shape[1]:
+                self.DB = bits.pack_rows(self.DU)
+            else:
+                DB = np.zeros((shape[0], n_words), dtype=np.uint64)
+                DB[:self.DB.shape[0]] = self.DB
+                changed = np.unique(docs)
+                DB[changed] = bits.pack_rows(self.DU[changed])
+                self.DB = DB
+
+        return delta
+
+    def _update_signatures(self, docs, delta):
+        """Updates the signatures of docs for the rows in delta, growing S to n_docs."""
+        S = np.empty((self.sig_len, self.n_docs), dtype=self.S.dtype)
+        S[:, :self.S.shape[1]] = self.S
+
+        if self.signature_method == 'oph':
+            rows = self.DU[docs]
+            S[:, docs] = signatures.one_permutation(
+                self.hash_params['ranks'], rows.indptr, rows.indices, self.sig_len)
+        else:
+            if self.signature_method == 'minhash':
+                fill = MINHASH_PRIME
+                table = signatures.minhash_table(
+                    self.hash_params['a'], self.hash_params['b'], fill, self.DU.shape[1])
+            else:
+                table = self.hash_params['table']
+                fill = table.shape[1]
+            S[:, self.S.shape[1]:] = fill
+
+            rows = delta[docs]
+            E = np.full((self.sig_len, len(docs)), fill, dtype=S.dtype)
+            signatures.min_signatures(table, rows.indptr, rows.indices, E, block=self.signature_block)
+            S[:, docs] = np.minimum(S[:, docs], E)
+        self.S = S
+
+        if self.bbits:
+            SB = np.zeros((self.n_docs, self.SB.shape[1]), dtype=np.uint64)
+            SB[:self.SB.shape[0]] = self.SB
+            SB[docs] = bits.pack_low_bits(S[:, docs], self.bbits)
+            self.SB = SB
+
+    def _score_batches(self, c1, c2, threshold, batch_size):
+        """Yields (c1, c2, similarity) batches of the given pairs above threshold."""
+        for start in range(0, len(c1), batch_size):
+            b1, b2 = c1[start:start + batch_size], c2[start:start + batch_size]
+            sim = self.sig_sim(b1, b2)
+            keep = sim >= threshold
+            yield b1[keep], b2[keep], sim[keep]
 
-            for d in range(self.n_docs):
-                bucket = hash(tuple(self.S[band_idx, d])) % self.max_buckets
-                self.buckets[bucket].add(d)
+    def _fill_buckets(self):
+        print("Filling buckets...")
+        t = time.time()
+        self.buckets = BucketTable.from_signatures(self.S, self.n_bands)
+        if self.max_bucket_size:
+            self.buckets.split(self.max_bucket_size, self._extra_signatures)
+        print("Done in {}s".format(time.time() - t))
 
-            print("  {}/{} done in {}s".format(b+1, self.n_bands, time.time() - t), end = '\r')
+    def _extra_signatures(self, docs):
+        """Returns one band of min-hash rows from new hash functions for docs."""
+        band_len = self.sig_len // self.n_bands
+        prime = MINHASH_PRIME
+        a = np.random.choice(self.n_shingles, size=band_len, replace=False)
+        b = np.random.choice(self.n_shingles, size=band_len, replace=False)
 
-        print("Done in {}s".format(time.time() - t))
+        rows = self.DU[docs]
+        table = signatures.minhash_table(a, b, prime, self.DU.shape[1])
+        E = np.full((band_len, len(docs)), prime, dtype=table.dtype)
+        return signatures.segment_min(table[:, rows.indices], rows.indptr, E)
 
 
 
@@ -224,56 +722,92 @@ class CachedPairFinder(PairFinder):
     results from cache first.
 
     If no cache is found, the computation is done by PairFinder and
-    the result saved for the next run.
+    the result saved for the next run. Cache keys include a hash of the
+    data, the state of the random number generator and all parameters
+    the result depends on (see cache.py). Signatures don't depend on
+    the number of bands, so they are shared by runs that only change it.
+
+    Args:
+        cache_dir (string): Directory of the cache.
+        cache_size (int, optional): Size cap of the cache in bytes.
+        All other arguments are those of PairFinder.
     """
 
+    def __init__(self, data, *args, cache_dir = "cache", cache_size = None, **kwargs):
+        super().__init__(data, *args, **kwargs)
+        self.cache = ArtifactCache(cache_dir, cache_size)
+        self.data_key = self.cache.fingerprint(data)
+
     def _compute_document_shingle_matrix(self):
-        cache_file = "cache/docshingle.npz"
-        #self.DS = sparse.load_npz(cache_file)
-        try:
-            if not self.sparse_ds:
-                raise Exception("not caching dense matrix")
-            self.DS = sparse.load_npz(cache_file)
+        if not self.sparse_ds:
+            # not caching dense matrix
+            return super()._compute_document_shingle_matrix()
+
+        k = cache.key('docshingle', self.data_key, self.first_id)
+        arrays = self.cache.get(k)
+        if arrays is not None:
+            ones = np.ones(len(arrays['indices']), dtype=np.uint8)
+            self.DS = sparse.csr_matrix((ones, arrays['indices'], arrays['indptr']),
+                                        shape=tuple(arrays['shape']))
+            del self.shingles
+            del self.docs
             print("Using cached document-shingle matrix")
-        except:
+        else:
             super()._compute_document_shingle_matrix()
-            if self.sparse_ds:
-                sparse.save_npz(open(cache_file, "wb"), self.DS)
-
-    def _compute_signatures(self):
-        cache_file = "cache/signature_{}_{}.npy".format(self.sig_len, self.signature_method)
-        try:
-            self.S = np.load(cache_file)
-            assert self.S.shape == (self.sig_len, self.n_docs)
+            self.cache.put(k, {'indptr': self.DS.indptr, 'indices': self.DS.indices,
+                               'shape': np.array(self.DS.shape)})
+
+    def _compute_signatures(self, rows = None):
+        rows = rows or slice(0, self.sig_len)
+        self.signature_key = cache.key('signatures', self.data_key, self.first_id,
+                                       self.signature_method, self.sig_len,
+                                       (rows.start, rows.stop), cache.random_state_key())
+        arrays = self.cache.get(self.signature_key)
+        if arrays is not None:
+            self.S = arrays['S']
+            self.hash_params = _unprefixed(arrays, 'hash_')
+            cache.restore_random_state(arrays)
             print("Using cached signatures")
-        except:
-            super()._compute_signatures()
-            np.save(open(cache_file, "wb"), self.S)
+        else:
+            super()._compute_signatures(rows)
+            arrays = _prefixed(self.hash_params, 'hash_')
+            arrays.update(cache.random_state_arrays())
+            arrays['S'] = self.S
+            self.cache.put(self.signature_key, arrays)
 
     def _fill_buckets(self):
-        cache_file = "cache/buckets_{}_{}_{}.pkl".format(
-            self.sig_len, self.n_bands, self.max_buckets)
-        try:
-            self.buckets = pickle.load(open(cache_file, "rb"))
+        k = cache.key('buckets', self.signature_key, self.n_bands, self.max_bucket_size,
+                      cache.random_state_key())
+        arrays = self.cache.get(k)
+        if arrays is not None:
+            self.buckets = BucketTable.from_arrays(arrays)
+            cache.restore_random_state(arrays)
             print("Using cached buckets")
-        except:
+        else:
             super()._fill_buckets()
-            pickle.dump(dict(self.buckets), open(cache_file, "wb"))
+            self.cache.put(k, dict(self.buckets.to_arrays(), **cache.random_state_arrays()))
+
 
 
+def _prefixed(arrays, prefix):
+    return {prefix + name: a for name, a in arrays.items()}
+
+
+def _unprefixed(arrays, prefix):
+    return {name[len(prefix):]: a for name, a in arrays.items() if name.startswith(prefix)}
+
 
 def build(*args, **kwargs):
     """Builds either PairFinder or CachedPairFinder.
 
     Args:
         cached (bool, optional): When true, builds a CachedPairFinder. Defaults to False.
+        cache_size (int, optional): Size cap of the cache in bytes (CachedPairFinder only).
         All other arguments are forwarded to the constructor of the class being built.
     """
-    cached = kwargs.get('cached', False)
-    del kwargs['cached']
-
-    if cached:
-        ensure_directory('cache')
+    cached = kwargs.pop('cached', False)
+    if not cached:
+        kwargs.pop('cache_size', None)
 
     cls = CachedPairFinder if cached else PairFinder
     return cls(*args, **kwargs)
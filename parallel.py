@@ -0,0 +1,234 @@
+import numpy as np
+from scipy import sparse
+import multiprocessing
+import collections
+import time
+
+import signatures
+
+
+"""Signature engines and verification split across worker processes.
+
+The input arrays and the signature matrix are copied once into shared
+memory (multiprocessing.RawArray) that the workers get when they start,
+so nothing is pickled per task. Workers write their part of the
+signature matrix directly into the shared copy. All random hash
+functions are drawn by the caller, so the result is the same for any
+number of workers.
+"""
+
+
+def min_signatures(table, indptr, indices, out, jobs, block=4):
+    """Like signatures.min_signatures, with blocks of hash functions split across jobs processes."""
+    with SignatureWorkers(table, indptr, indices, out, jobs, block) as workers:
+        return workers.compute(0, table.shape[0])
+
+
+def one_permutation(ranks, indptr, indices, n_bins, jobs, block=65536):
+    """Like signatures.one_permutation, with blocks of documents split across jobs processes."""
+    n_docs = len(indptr) - 1
+    width = -(-len(ranks) // n_bins)
+    out = np.empty((n_bins, n_docs), dtype=np.min_scalar_type(n_bins * width))
+    tasks = [(start, min(start + block, n_docs), n_bins) for start in range(0, n_docs, block)]
+
+    shared = _share(ranks=ranks, indptr=indptr, indices=indices, out=out)
+    with multiprocessing.Pool(jobs, initializer=_attach, initargs=(shared,)) as pool:
+        for _ in pool.imap_unordered(_one_permutation_block, tasks):
+            pass
+
+    out[:] = _view(*shared['out'])
+    return out
+
+
+class SignatureWorkers:
+    """Computes rows of min-hash signatures in worker processes started once.
+
+    The table, the document index and the signature matrix are shared
+    when the workers start, so rows can be computed in many calls, e.g.
+    band by band, without copying the inputs again. With jobs <= 1, rows
+    are computed in this process.
+
+    Use as a context manager, leaving it stops all workers.
+
+    Args:
+        table (numpy.ndarray): Hash value of every shingle (columns) for
+            every hash function (rows).
+        indptr (numpy.ndarray): Start of every document's shingles in
+            indices, plus the end of the last document.
+        indices (numpy.ndarray): Shingle ids of all nonzeros.
+        out (numpy.ndarray): Signature matrix, pre-filled as for
+            signatures.min_signatures.
+        jobs (int): Number of worker processes.
+        block (int): Number of hash functions per task.
+    """
+
+    def __init__(self, table, indptr, indices, out, jobs, block = 4):
+        self.table = table
+        self.indptr = indptr
+        self.indices = indices
+        self.out = out
+        self.block = block
+        self.pool = None
+        if jobs > 1:
+            self.shared = _share(table=table, indptr=indptr, indices=indices, out=out)
+            self.pool = multiprocessing.Pool(jobs, initializer=_attach, initargs=(self.shared,))
+
+    def compute(self, start, stop):
+        """Fills rows start to stop of out and returns out."""
+        if self.pool is None:
+            signatures.min_signatures(self.table[start:stop], self.indptr, self.indices,
+                                      self.out[start:stop], block=self.block)
+            return self.out
+
+        t = time.time()
+        tasks = [(first, min(first + self.block, stop)) for first in range(start, stop, self.block)]
+        for k, _ in enumerate(self.pool.imap_unordered(_min_block, tasks)):
+            print("  {}/{} blocks done in {}s".format(k + 1, len(tasks), time.time() - t), end = '\r')
+        print("")
+
+        self.out[start:stop] = _view(*self.shared['out'])[start:stop]
+        return self.out
+
+    def close(self):
+        """Stops all workers."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParallelVerifier:
+    """Verifies batches of candidates in worker processes, results in order.
+
+    The workers share the document-major matrix (or its bit-packed copy)
+    and the set sizes of pf. Up to window batches are in flight at once,
+    so the candidate stream is consumed only as fast as it is verified.
+    With jobs <= 1, batches are verified in this process.
+
+    Use as a context manager, leaving it stops all workers, also if
+    batches are still in flight.
+
+    Args:
+        pf (PairFinder): Prepared pair finder.
+        jobs (int): Number of worker processes.
+        window (int, optional): Maximum number of batches in flight.
+            Default: 2 * jobs.
+    """
+
+    def __init__(self, pf, jobs, window = None):
+        self.pf = pf
+        self.jobs = jobs
+        self.window = window or 2 * jobs
+        self.pool = None
+        if jobs > 1:
+            if pf.bits_ds:
+                shared = _share(DB=pf.DB, doc_sizes=pf.doc_sizes)
+            else:
+                shared = _share(data=pf.DU.data, indices=pf.DU.indices, indptr=pf.DU.indptr,
+                                doc_sizes=pf.doc_sizes)
+            shared['shape'] = pf.DU.shape
+            self.pool = multiprocessing.Pool(jobs, initializer=_attach_verifier, initargs=(shared,))
+
+    def map(self, batches):
+        """Yields (batch, Jaccard similarities) for every batch, in order.
+
+        Args:
+            batches (iterable): Tuples whose first two entries are the
+                arrays c1 and c2 of the pairs to verify.
+        """
+        if self.pool is None:
+            for batch in batches:
+                yield batch, self.pf.verify_batch(batch[0], batch[1])
+            return
+
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, self.pool.apply_async(_verify, (batch[0], batch[1]))))
+            if len(pending) >= self.window:
+                batch, result = pending.popleft()
+                yield batch, result.get()
+        while pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+
+    def close(self):
+        """Stops all workers."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+##### Private functions
+
+# arrays of the current worker, set by _attach or _attach_verifier
+_arrays = {}
+
+
+def _share(**arrays):
+    """Copies arrays into shared memory, returns (buffer, dtype, shape) by name."""
+    shared = {}
+    for name, a in arrays.items():
+        raw = multiprocessing.RawArray('b', max(a.nbytes, 1))
+        shared[name] = (raw, a.dtype.str, a.shape)
+        _view(*shared[name])[...] = a
+    return shared
+
+
+def _view(raw, dtype, shape):
+    count = int(np.prod(shape, dtype=np.int64))
+    return np.frombuffer(raw, dtype=dtype, count=count).reshape(shape)
+
+
+def _attach(shared):
+    for name, s in shared.items():
+        _arrays[name] = _view(*s)
+
+
+def _min_block(bounds):
+    start, stop = bounds
+    table, indptr, indices = _arrays['table'], _arrays['indptr'], _arrays['indices']
+    values = table[start:stop, :][:, indices]
+    signatures.segment_min(values, indptr, _arrays['out'][start:stop, :])
+    return stop
+
+
+def _one_permutation_block(bounds):
+    start, stop, n_bins = bounds
+    indptr, indices = _arrays['indptr'], _arrays['indices']
+    lo, hi = indptr[start], indptr[stop]
+    _arrays['out'][:, start:stop] = signatures.one_permutation(
+        _arrays['ranks'], indptr[start:stop + 1] - lo, indices[lo:hi], n_bins)
+    return stop
+
+
+def _attach_verifier(shared):
+    from pair_finder import PairFinder
+
+    pf = PairFinder.__new__(PairFinder)
+    pf.doc_sizes = _view(*shared['doc_sizes'])
+    pf.bits_ds = 'DB' in shared
+    if pf.bits_ds:
+        pf.DB = _view(*shared['DB'])
+    else:
+        pf.DU = sparse.csr_matrix((_view(*shared['data']), _view(*shared['indices']),
+                                   _view(*shared['indptr'])), shape=shared['shape'])
+        pf.DU.has_sorted_indices = True
+    _arrays['pf'] = pf
+
+
+def _verify(c1, c2):
+    return _arrays['pf'].verify_batch(c1, c2)
@@ -0,0 +1,72 @@
+import numpy as np
+
+from buckets import pack_pairs, unpack_pairs
+
+
+"""Score-bucketed queue for streaming candidates best-first."""
+
+
+class LevelQueue:
+    """Queue of pairs bucketed by an integer score level.
+
+    Pairs are stored as packed uint64 keys, one list of arrays per level,
+    and drained from the highest level down. When more than max_size
+    pairs are queued, the lowest levels are dropped, and pairs below the
+    lowest remaining level are rejected from then on, so memory stays
+    bounded.
+
+    Args:
+        n_levels (int): Number of levels (scores 0 to n_levels - 1).
+        max_size (int, optional): Maximum number of queued pairs.
+    """
+
+    def __init__(self, n_levels, max_size=None):
+        self.levels = [[] for _ in range(n_levels)]
+        self.counts = np.zeros(n_levels, dtype=np.int64)
+        self.max_size = max_size
+        self.floor = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return int(np.sum(self.counts))
+
+    def push(self, c1, c2, level):
+        """Adds pairs (c1[i], c2[i]) with score level[i]."""
+        keep = level >= self.floor
+        self.dropped += int(np.sum(~keep))
+        keys = pack_pairs(c1[keep], c2[keep])
+        level = level[keep]
+
+        order = np.argsort(level, kind='mergesort')
+        keys, level = keys[order], level[order]
+        bounds = np.searchsorted(level, np.arange(len(self.levels) + 1))
+        for l in np.unique(level):
+            self.levels[l].append(keys[bounds[l]:bounds[l + 1]])
+            self.counts[l] += bounds[l + 1] - bounds[l]
+
+        self._shrink()
+
+    def drain(self, batch_size):
+        """Yields all queued pairs, highest level first, and empties the queue.
+
+        Yields:
+            tuple: (c1, c2) arrays of at most batch_size pairs, all of
+                one level.
+        """
+        for l in range(len(self.levels) - 1, -1, -1):
+            if self.counts[l] == 0:
+                continue
+            keys = np.concatenate(self.levels[l])
+            self.levels[l] = []
+            self.counts[l] = 0
+            for start in range(0, len(keys), batch_size):
+                yield unpack_pairs(keys[start:start + batch_size])
+
+    def _shrink(self):
+        if self.max_size is None:
+            return
+        while len(self) > self.max_size and self.floor < len(self.levels) - 1:
+            self.dropped += int(self.counts[self.floor])
+            self.levels[self.floor] = []
+            self.counts[self.floor] = 0
+            self.floor += 1
@@ -0,0 +1,175 @@
+import numpy as np
+import csv
+import os
+import queue
+import threading
+import time
+
+from buckets import pack_pairs
+from util import ensure_directory
+
+
+"""Buffered result file with checkpoints for resuming killed runs.
+
+Rows are written by a background thread, many at a time, so the
+verification loop never waits for the disk. Every sync_interval seconds
+the file is synced and a checkpoint is written next to it, holding the
+position in the candidate stream (the cursor), the length of the file
+and all confirmed pairs, all up to the last synced row.
+
+A run started with resume=True truncates the file to the length in the
+checkpoint, which drops rows written after it, and continues from its
+cursor. The candidate stream is the same for the same data, seed and
+parameters, and the checkpoint is only used if its key matches, so no
+pair is verified or written twice. Every run writes a checkpoint of its
+starting state right away, so a checkpoint of an earlier run is never
+resumed from.
+"""
+
+
+class ResultSink:
+    """Writes rows of results in a background thread, with checkpoints.
+
+    Args:
+        filename (string): File to write the rows to (CSV).
+        append (bool): Append to the file instead of overwriting it.
+        checkpoint (string, optional): Checkpoint file. Default:
+            filename + ".checkpoint.npz".
+        key (string): Identifies the candidate stream. Checkpoints with
+            another key are ignored.
+        resume (bool): Continue from the checkpoint, if there is one.
+        sync_interval (float): Seconds between syncs and checkpoints.
+
+    Attributes:
+        cursor (int): Number of candidates of the stream already done.
+        confirmed (numpy.ndarray): Pairs written so far, packed with
+            buckets.pack_pairs and sorted.
+    """
+
+    def __init__(self, filename, append = False, checkpoint = None, key = "",
+                 resume = False, sync_interval = 1.0):
+        ensure_directory(f=filename)
+        self.checkpoint = checkpoint or filename + ".checkpoint.npz"
+        self.key = key
+        self.sync_interval = sync_interval
+        self.cursor = 0
+        self.confirmed = np.array([], dtype=np.uint64)
+
+        state = self._load_checkpoint(filename) if resume else None
+        if state is not None:
+            with open(filename, "r+") as f:
+                f.truncate(int(state['offset']))
+            self.cursor = int(state['cursor'])
+            self.confirmed = state['pairs']
+            append = True
+            print("Resuming after {} candidates and {} pairs".format(self.cursor, len(self.confirmed)))
+
+        self.f = open(filename, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.found = [self.confirmed]
+        self._sync()
+
+        self.requests = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def write(self, rows, c1, c2, cursor):
+        """Queues rows for writing.
+
+        Args:
+            rows (list): Rows (lists of fields) to write.
+            c1 (numpy.ndarray): First documents of the pairs in rows.
+            c2 (numpy.ndarray): Second documents of the pairs in rows.
+            cursor (int): Number of candidates of the stream done once
+                these rows are written.
+        """
+        if self.error is not None:
+            raise self.error
+        self.requests.put((rows, pack_pairs(c1, c2), cursor))
+
+    def is_confirmed(self, c1, c2):
+        """Returns a boolean array of the pairs already written, up to the last sync."""
+        pairs = pack_pairs(c1, c2)
+        confirmed = self.confirmed  # replaced, not changed, by the writer thread
+        if len(confirmed) == 0:
+            return np.zeros(len(pairs), dtype=bool)
+        pos = np.minimum(np.searchsorted(confirmed, pairs), len(confirmed) - 1)
+        return confirmed[pos] == pairs
+
+    def close(self):
+        """Writes all queued rows, syncs and writes the last checkpoint."""
+        if self.worker is None:
+            return
+        self.requests.put(None)
+        self.worker.join()
+        self.worker = None
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+    ##### Private methods
+
+    def _run(self):
+        done = False
+        while not done:
+            # take everything that's queued, to write it in one go
+            requests = []
+            try:
+                requests.append(self.requests.get(timeout=self.sync_interval))
+                while True:
+                    requests.append(self.requests.get_nowait())
+            except queue.Empty:
+                pass
+            done = None in requests
+
+            try:
+                for rows, pairs, cursor in filter(None, requests):
+                    self.writer.writerows(rows)
+                    self.found.append(pairs)
+                    self.cursor = cursor
+                self.f.flush()
+                if done or time.time() - self.synced_t >= self.sync_interval:
+                    self._sync()
+            except Exception as e:
+                self.error = e
+                done = True
+
+    def _sync(self):
+        os.fsync(self.f.fileno())
+        self.confirmed = np.sort(np.concatenate(self.found))
+        self.found = [self.confirmed]
+
+        # write next to the checkpoint and replace it, so that a kill
+        # never leaves a partial checkpoint
+        tmp = "{}.tmp{}".format(self.checkpoint, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, key=np.array(self.key), cursor=np.array(self.cursor),
+                     offset=np.array(os.fstat(self.f.fileno()).st_size), pairs=self.confirmed)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint)
+        self.synced_t = time.time()
+
+    def _load_checkpoint(self, filename):
+        if not os.path.exists(self.checkpoint):
+            print("No checkpoint to resume from in {}".format(self.checkpoint))
+            return None
+        state = dict(np.load(self.checkpoint))
+        if str(state['key']) != self.key:
+            print("Ignoring checkpoint {} of other data or parameters".format(self.checkpoint))
+            return None
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if int(state['offset']) > size:
+            print("Ignoring checkpoint {}, {} is shorter than its {} bytes".format(
+                self.checkpoint, filename, int(state['offset'])))
+            return None
+        return state
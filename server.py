@@ -0,0 +1,162 @@
+import numpy as np
+import json
+import queue
+import socketserver
+import threading
+import time
+
+from filters import default_cascade
+
+
+"""Similarity queries over a prepared PairFinder on a local socket.
+
+Clients send one JSON object per line and get one JSON object per line
+back. User IDs are those of the data (starting at first_id).
+
+    {"op": "similar", "user": 17, "threshold": 0.5}
+    -> {"users": [...], "jaccard": [...], "signature": [...]}
+    {"op": "jaccard", "users": [17, 42]}
+    -> {"jaccard": 0.61}
+
+Errors are answered with {"error": message}. Every connection is
+handled in its own thread, and the exact verifications of all threads
+are collected by a BatchVerifier, so concurrent queries share one
+vectorized verify_batch() call.
+"""
+
+
+class BatchVerifier:
+    """Verifies pairs for many threads in shared batches.
+
+    Args:
+        pf (PairFinder): Prepared pair finder.
+        max_wait (float): Seconds to wait for more requests before
+            verifying a batch.
+        max_batch (int): Verify at most about this many pairs at once.
+    """
+
+    def __init__(self, pf, max_wait = 0.002, max_batch = 2**16):
+        self.pf = pf
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.pairs = 0
+
+        worker = threading.Thread(target=self._run, daemon=True)
+        worker.start()
+
+    def verify(self, c1, c2):
+        """Returns the Jaccard similarities of pairs, like PairFinder.verify_batch()."""
+        request = {'c1': c1, 'c2': c2, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+
+
+    ##### Private methods
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0]['c1'])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+                size += len(batch[-1]['c1'])
+
+            try:
+                sims = self.pf.verify_batch(np.concatenate([r['c1'] for r in batch]),
+                                            np.concatenate([r['c2'] for r in batch]))
+                ends = np.cumsum([len(r['c1']) for r in batch])
+                for r, part in zip(batch, np.split(sims, ends[:-1])):
+                    r['result'] = part
+            except Exception as e:
+                for r in batch:
+                    r['error'] = e
+
+            self.batches += 1
+            self.pairs += size
+            for r in batch:
+                r['done'].set()
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """Answers the JSON-lines requests of one connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.answer(json.loads(line.decode()))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingTCPServer):
+    """Threaded server for similarity queries.
+
+    Args:
+        pf (PairFinder): Prepared pair finder.
+        address (tuple): (host, port) to listen on.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pf, address = ("127.0.0.1", 7733)):
+        super().__init__(address, QueryHandler)
+        self.pf = pf
+        self.verifier = BatchVerifier(pf)
+
+    def answer(self, request):
+        """Returns the response to a decoded request."""
+        op = request.get('op')
+        if op == 'similar':
+            return self.similar(request['user'], request.get('threshold', .5))
+        elif op == 'jaccard':
+            u1, u2 = request['users']
+            c1, c2 = self._doc(u1), self._doc(u2)
+            return {'jaccard': float(self.verifier.verify(np.array([c1]), np.array([c2]))[0])}
+        raise ValueError("'{}' is not an operation.".format(op))
+
+    def similar(self, user, threshold):
+        """Returns the users with Jaccard similarity above threshold to user.
+
+        Candidates come from the buckets of the user. Those whose
+        signature similarity makes it implausible to reach the
+        threshold are dropped before the exact verification (see
+        filters.py). The result is sorted by decreasing similarity.
+        """
+        doc = self._doc(user)
+        others, sim = self.pf.query_candidates(doc)
+        c1 = np.full(len(others), doc)
+        keep = default_cascade(self.pf, threshold)(self.pf, c1, others, sim)
+        others, sim = others[keep], sim[keep]
+
+        jac = self.verifier.verify(c1[keep], others)
+        found = jac >= threshold
+        order = np.argsort(-jac[found], kind='mergesort')
+        return {'users': (others[found][order] + self.pf.first_id).tolist(),
+                'jaccard': jac[found][order].tolist(),
+                'signature': sim[found][order].tolist()}
+
+
+
+    ##### Private methods
+
+    def _doc(self, user):
+        doc = int(user) - self.pf.first_id
+        if not 0 <= doc < self.pf.n_docs:
+            raise ValueError("Unknown user {}".format(user))
+        return doc
+
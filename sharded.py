@@ -0,0 +1,198 @@
+import numpy as np
+import glob
+import multiprocessing
+import os
+import shutil
+import time
+
+from buckets import pack_pairs, unpack_pairs, mix
+from filters import SizeRatioFilter
+from util import ensure_directory
+
+
+"""Band-sharded map/reduce mode for data too large for one process.
+
+The bands are split into shards. A map task prepares the signatures and
+buckets of one shard's bands only (PairFinder.prepare_bands), and spills
+the packed keys of its candidate pairs to files, partitioned by a hash
+of the key. A reduce task collects one partition from all shards,
+removes duplicates with np.unique and verifies the remaining pairs.
+
+All tasks coordinate through a directory only: a task writes its files
+and then a marker file, and reduce tasks wait for the markers of all
+map tasks. Any process on any node that sees the directory can run any
+task (see the shard-map and shard-reduce commands), given the same
+data, seed and parameters. run() runs all tasks as local processes.
+
+Layout of the directory:
+    part-<p>/shard-<s>-<n>.npy   packed pairs of shard s for partition p
+    map-<s>.done                 shard s is complete
+    pairs-<p>.csv                verified pairs of partition p
+    reduce-<p>.done              partition p is complete
+"""
+
+
+def shard_bands(shard, n_shards, n_bands):
+    """Returns the range (first, last) of bands owned by a shard."""
+    bounds = np.linspace(0, n_bands, n_shards + 1).astype(int)
+    return int(bounds[shard]), int(bounds[shard + 1])
+
+
+def map_shard(pf, shard, n_shards, directory, n_partitions, spill_size = 2**22):
+    """Spills the candidate pairs of one shard's bands to partition files.
+
+    Args:
+        pf (PairFinder): Pair finder with sig_len and bands set. Only its
+            matrices need to be prepared.
+        shard (int): Index of the shard.
+        n_shards (int): Number of shards.
+        directory (string): Directory shared by all tasks.
+        n_partitions (int): Number of reduce partitions.
+        spill_size (int): Pairs buffered in memory before spilling.
+    """
+    print("Map shard {}/{}...".format(shard + 1, n_shards))
+    t = time.time()
+    first, last = shard_bands(shard, n_shards, pf.n_bands)
+    pf.prepare_bands(first, last)
+
+    buffered = []
+    n_buffered = 0
+    n_files = 0
+    n_pairs = 0
+    for c1, c2 in pf.buckets.pair_batches(2**16):
+        buffered.append(pack_pairs(c1, c2))
+        n_buffered += len(c1)
+        if n_buffered >= spill_size:
+            _spill(np.concatenate(buffered), directory, shard, n_files, n_partitions)
+            n_files += 1
+            n_pairs += n_buffered
+            buffered, n_buffered = [], 0
+    if n_buffered > 0:
+        _spill(np.concatenate(buffered), directory, shard, n_files, n_partitions)
+        n_pairs += n_buffered
+
+    _mark(directory, "map-{}".format(shard))
+    print("Spilled {} pairs of bands {} to {}".format(n_pairs, first, last - 1))
+    print("Done in {}s".format(time.time() - t))
+
+
+def reduce_partition(pf, partition, n_shards, directory, threshold = .5, batch_size = 2**16):
+    """Deduplicates and verifies the pairs of one partition.
+
+    Waits until all map tasks are done. Found pairs are written to
+    pairs-<partition>.csv, with the IDs of the data.
+
+    Args:
+        pf (PairFinder): Pair finder with prepared matrices.
+        partition (int): Index of the partition.
+        n_shards (int): Number of map tasks to wait for.
+        directory (string): Directory shared by all tasks.
+        threshold (float): Jaccard similarity of the pairs to find.
+        batch_size (int): Number of pairs verified at once.
+
+    Returns:
+        int: Number of pairs found.
+    """
+    _wait(directory, ["map-{}".format(s) for s in range(n_shards)])
+
+    print("Reduce partition {}...".format(partition))
+    t = time.time()
+    files = sorted(glob.glob(os.path.join(directory, "part-{}".format(partition), "*.npy")))
+    if files:
+        keys = np.unique(np.concatenate([np.load(f) for f in files]))
+    else:
+        keys = np.array([], dtype=np.uint64)
+    c1, c2 = unpack_pairs(keys)
+    del keys
+
+    size_filter = SizeRatioFilter(threshold)
+    found = []
+    for start in range(0, len(c1), batch_size):
+        b1, b2 = c1[start:start + batch_size], c2[start:start + batch_size]
+        keep = size_filter(pf, b1, b2, None)
+        b1, b2 = b1[keep], b2[keep]
+        similar = pf.verify_batch(b1, b2) > threshold
+        found.append(np.column_stack([b1[similar], b2[similar]]))
+
+    pairs = np.concatenate(found) if found else np.zeros((0, 2), dtype=np.int64)
+    np.savetxt(os.path.join(directory, "pairs-{}.csv".format(partition)),
+               pairs + pf.first_id, fmt='%d', delimiter=',')
+    _mark(directory, "reduce-{}".format(partition))
+    print("Verified {} distinct candidates, found {} pairs in {}s".format(
+        len(c1), len(pairs), time.time() - t))
+    return len(pairs)
+
+
+def run(pf, directory, n_shards, n_partitions, jobs, results):
+    """Runs all map and reduce tasks with up to jobs local processes.
+
+    Previous contents of directory are removed. The pairs of all
+    partitions are collected in results.
+
+    Returns:
+        int: Number of pairs found.
+    """
+    ensure_directory(directory)
+    for f in glob.glob(os.path.join(directory, "*.done")):
+        os.remove(f)
+    for d in glob.glob(os.path.join(directory, "part-*")):
+        shutil.rmtree(d)
+
+    # pf is passed once per worker when it starts, forked workers
+    # inherit it without pickling its matrices
+    with multiprocessing.Pool(jobs, initializer=_attach, initargs=(pf, np.random.get_state())) as pool:
+        pool.starmap(_map_task, [(s, n_shards, directory, n_partitions) for s in range(n_shards)])
+        counts = pool.starmap(_reduce_task, [(p, n_shards, directory) for p in range(n_partitions)])
+
+    ensure_directory(f=results)
+    with open(results, "w") as out:
+        for p in range(n_partitions):
+            with open(os.path.join(directory, "pairs-{}.csv".format(p))) as f:
+                out.write(f.read())
+    return sum(counts)
+
+
+
+##### Private functions
+
+# pair finder and random state of local tasks, set by _attach
+_task_state = {}
+
+
+def _attach(pf, random_state):
+    _task_state['pf'] = pf
+    _task_state['random'] = random_state
+
+
+def _map_task(shard, n_shards, directory, n_partitions):
+    # every shard has to start from the same random state to get the
+    # same hash functions, also if a worker runs several shards
+    np.random.set_state(_task_state['random'])
+    pf = _task_state['pf']
+    pf.jobs = 1 # the tasks already use all processes
+    map_shard(pf, shard, n_shards, directory, n_partitions)
+
+
+def _reduce_task(partition, n_shards, directory):
+    return reduce_partition(_task_state['pf'], partition, n_shards, directory)
+
+
+def _spill(keys, directory, shard, n, n_partitions):
+    part = mix(keys) % np.uint64(n_partitions)
+    order = np.argsort(part, kind='mergesort')
+    keys, part = keys[order], part[order]
+    bounds = np.searchsorted(part, np.arange(n_partitions + 1, dtype=np.uint64))
+    for p in range(n_partitions):
+        d = os.path.join(directory, "part-{}".format(p))
+        ensure_directory(d)
+        np.save(os.path.join(d, "shard-{}-{}.npy".format(shard, n)), keys[bounds[p]:bounds[p + 1]])
+
+
+def _mark(directory, name):
+    with open(os.path.join(directory, name + ".done"), "w"):
+        pass
+
+
+def _wait(directory, names, interval = 0.5):
+    while not all(os.path.exists(os.path.join(directory, n + ".done")) for n in names):
+        time.sleep(interval)
@@ -0,0 +1,171 @@
+import numpy as np
+import time
+
+
+"""Vectorized signature engines.
+
+All engines work on the document-major layout of the document-shingle
+matrix, i.e. the indptr/indices arrays of a CSC matrix with shingles as
+rows and documents as columns. Hash values are looked up for all
+nonzeros of a block of hash functions at once and reduced per document
+with segment-wise minima over indptr, instead of looping over shingles
+in Python.
+"""
+
+
+def minhash_table(a, b, prime, n_shingles):
+    """Returns the hash values of all shingles for every hash function.
+
+    Hash function i is hash(x) = (a[i]*x + b[i]) % prime. The result has
+    shape (len(a), n_shingles) and the smallest unsigned dtype that can
+    hold prime, to keep the per-nonzero lookups small.
+    """
+    a = np.asarray(a, dtype=np.int64).reshape(-1, 1)
+    b = np.asarray(b, dtype=np.int64).reshape(-1, 1)
+    x = np.arange(n_shingles, dtype=np.int64)
+    return ((a * x + b) % prime).astype(np.min_scalar_type(prime))
+
+
+def permutation_table(n_permutations, n_shingles):
+    """Returns the rank of every shingle in n_permutations random permutations.
+
+    The result has shape (n_permutations, n_shingles). The minimum rank
+    over a document's shingles is the index of its first nonzero row in
+    the correspondingly permuted document-shingle matrix.
+    """
+    dtype = np.min_scalar_type(n_shingles)
+    table = np.empty((n_permutations, n_shingles), dtype=dtype)
+    for i in range(n_permutations):
+        table[i, :] = np.random.permutation(n_shingles)
+    return table
+
+
+def segment_min(values, indptr, out):
+    """Writes the minimum of every segment of values along the last axis to out.
+
+    Segment i is values[..., indptr[i]:indptr[i+1]]. Entries of out for
+    empty segments are left untouched.
+    """
+    # reduceat can't handle empty segments, so only reduce non-empty ones.
+    # Their starts are strictly increasing and each reduction stops at the
+    # next non-empty start, which is exactly the end of the segment.
+    nonempty = indptr[:-1] < indptr[1:]
+    if np.any(nonempty):
+        out[..., nonempty] = np.minimum.reduceat(values, indptr[:-1][nonempty], axis=-1)
+    return out
+
+
+def min_signatures(table, indptr, indices, out, block=4):
+    """Computes min-hash signatures from per-shingle hash values.
+
+    Args:
+        table (numpy.ndarray): Hash value of every shingle (columns) for
+            every hash function (rows).
+        indptr (numpy.ndarray): Start of every document's shingles in
+            indices, plus the end of the last document.
+        indices (numpy.ndarray): Shingle ids of all nonzeros.
+        out (numpy.ndarray): Signature matrix of shape (len(table),
+            len(indptr) - 1), pre-filled with the value for documents
+            without shingles.
+        block (int): Number of hash functions processed at once. Memory
+            use is about block * len(indices) * table.itemsize bytes.
+
+    Returns:
+        numpy.ndarray: out
+    """
+    t = time.time()
+    n_hashes = table.shape[0]
+    for start in range(0, n_hashes, block):
+        stop = min(start + block, n_hashes)
+        values = table[start:stop, :][:, indices]
+        segment_min(values, indptr, out[start:stop, :])
+        print("  {}/{} done in {}s".format(stop, n_hashes, time.time() - t), end = '\r')
+    print("")
+    return out
+
+
+def one_permutation(ranks, indptr, indices, n_bins):
+    """Computes densified one-permutation hashing signatures.
+
+    The permuted shingle space (given by the rank of every shingle) is
+    split into n_bins bins, rank r into bin r * n_bins // len(ranks), so
+    their widths differ by at most one. Every document keeps the
+    minimum rank offset within each bin. This needs a single pass over
+    the nonzeros for the whole signature. Empty bins are filled by
+    rotation (see densify).
+
+    Args:
+        ranks (numpy.ndarray): Position of every shingle in the random
+            permutation.
+        indptr (numpy.ndarray): Start of every document's shingles in
+            indices, plus the end of the last document.
+        indices (numpy.ndarray): Shingle ids of all nonzeros.
+        n_bins (int): Signature length.
+
+    Returns:
+        numpy.ndarray: Signature matrix of shape (n_bins, len(indptr) - 1).
+            Documents without shingles get the value n_bins times the
+            largest bin width, which is larger than any other value. The dtype is the
+            smallest unsigned type that holds this value.
+    """
+    n_docs = len(indptr) - 1
+    n_ranks = len(ranks)
+    width = -(-n_ranks // n_bins)
+
+    # Encode (document, bin, offset) in one integer, so sorting it puts
+    # the minimum offset first for every (document, bin). Bin b starts
+    # at rank ceil(b * n_ranks / n_bins).
+    docs = np.repeat(np.arange(n_docs, dtype=np.int64), np.diff(indptr))
+    r = ranks[indices[:indptr[-1]]].astype(np.int64)
+    b = r * n_bins // n_ranks
+    code = (docs * n_bins + b) * width + r + (b * n_ranks // -n_bins)
+    del docs, r, b
+    code.sort()
+
+    key = code // width
+    first = np.ones(len(key), dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+
+    M = np.full(n_docs * n_bins, -1, dtype=np.int64)
+    M[key[first]] = code[first] % width
+    M.shape = (n_docs, n_bins)
+    del code, key, first
+
+    densify(M, empty=-1, offset=width, fill=n_bins * width)
+    return np.ascontiguousarray(M.T, dtype=np.min_scalar_type(n_bins * width))
+
+
+def densify(M, empty, offset, fill, block=65536):
+    """Fills empty bins of one-permutation signatures in place.
+
+    Every empty bin takes the value of the nearest non-empty bin to its
+    right (wrapping around) plus offset times the distance, so that
+    borrowed values can't be confused with values of the bin itself.
+    Rows without any non-empty bin are set to fill.
+
+    Args:
+        M (numpy.ndarray): Signatures with one row per document.
+        empty: Value marking empty bins.
+        offset (int): Must be larger than any bin value.
+        fill: Value for rows without non-empty bins.
+        block (int): Number of rows processed at once.
+    """
+    n_bins = M.shape[1]
+    cols = np.arange(2 * n_bins)
+
+    for start in range(0, M.shape[0], block):
+        m = M[start:start + block]
+        filled = np.tile(m != empty, 2)
+
+        # index of the nearest non-empty bin at or after each bin
+        nearest = np.where(filled, cols, 2 * n_bins)
+        nearest = np.minimum.accumulate(nearest[:, ::-1], axis=1)[:, ::-1][:, :n_bins]
+
+        any_filled = nearest[:, 0] < 2 * n_bins
+        rows = np.arange(m.shape[0]).reshape(-1, 1)
+        src = np.minimum(nearest, 2 * n_bins - 1) % n_bins
+        dist = np.maximum(nearest - cols[:n_bins], 0)
+
+        m[:, :] = np.where(any_filled.reshape(-1, 1),
+                           m[rows, src] + dist * offset,
+                           fill)